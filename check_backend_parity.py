@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Compares the predictions of an exported inference backend against the detectron2 model it was exported from.
+For every image, each detectron2 instance is matched to the exported instance of the same class with the
+highest box IoU, and the box IoU, mask IoU and score difference of the matches are reported.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from detectron2.structures import pairwise_iou
+
+import gen_metadata as gm
+from model_backends import BACKENDS
+
+CLASSES = ['fish', 'ruler', 'eye', 'two', 'three']
+DEFAULT_IMAGE_DIR = os.path.join(gm.root_dir_path, 'gen_metadata_mini', 'image_test')
+
+
+def mask_iou(mask1, mask2):
+    """
+    Returns the intersection over union of two boolean masks.
+    """
+    union = np.logical_or(mask1, mask2).sum()
+    if not union:
+        return 1.0
+    return np.logical_and(mask1, mask2).sum() / union
+
+
+def compare_instances(reference, candidate):
+    """
+    Matches the candidate instances to the reference instances class by class.
+    Parameters:
+        reference -- Instances predicted by the detectron2 backend.
+        candidate -- Instances predicted by the exported backend.
+    Returns:
+        report -- dictionary with instance counts and per class lists of box IoU, mask IoU and score differences.
+    """
+    reference, candidate = reference.to('cpu'), candidate.to('cpu')
+    report = {'reference_count': len(reference), 'candidate_count': len(candidate), 'classes': {}}
+    for k, name in enumerate(CLASSES):
+        ref = reference[reference.pred_classes == k]
+        cand = candidate[candidate.pred_classes == k]
+        stats = {'reference_count': len(ref), 'candidate_count': len(cand),
+                 'box_iou': [], 'mask_iou': [], 'score_diff': []}
+        if len(ref) and len(cand):
+            ious = pairwise_iou(ref.pred_boxes, cand.pred_boxes)
+            best_iou, best = ious.max(dim=1)
+            for i, j in enumerate(best.tolist()):
+                stats['box_iou'].append(float(best_iou[i]))
+                stats['mask_iou'].append(float(mask_iou(ref.pred_masks[i].numpy(), cand.pred_masks[j].numpy())))
+                stats['score_diff'].append(abs(float(ref.scores[i]) - float(cand.scores[j])))
+        report['classes'][name] = stats
+    return report
+
+
+def summarize(reports):
+    """
+    Aggregates per image reports into the minimum and mean IoUs and maximum score difference per class.
+    """
+    summary = {}
+    for name in CLASSES:
+        box = [v for r in reports.values() for v in r['classes'][name]['box_iou']]
+        mask = [v for r in reports.values() for v in r['classes'][name]['mask_iou']]
+        score = [v for r in reports.values() for v in r['classes'][name]['score_diff']]
+        count_mismatches = sum(r['classes'][name]['reference_count'] != r['classes'][name]['candidate_count']
+                               for r in reports.values())
+        summary[name] = {'matches': len(box), 'count_mismatches': count_mismatches,
+                         'box_iou_min': min(box, default=None), 'box_iou_mean': float(np.mean(box)) if box else None,
+                         'mask_iou_min': min(mask, default=None),
+                         'mask_iou_mean': float(np.mean(mask)) if mask else None,
+                         'score_diff_max': max(score, default=None)}
+    return summary
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Check that an exported backend reproduces the detectron2 predictions.')
+    parser.add_argument('image_directory', nargs='?', default=DEFAULT_IMAGE_DIR,
+                        help='Directory of fish images to compare on.')
+    parser.add_argument('--backend', choices=BACKENDS[1:], default='onnx',
+                        help='Exported backend to compare against detectron2.')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='Device used for the detectron2 model.')
+    parser.add_argument('--outfname',
+                        help='Output filename for the full per image report in JSON.')
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    reference_predictor = gm.init_model(device=args.device)
+    candidate_predictor = gm.init_model(device=args.device, backend=args.backend)
+    reports = {}
+    for entry in sorted(os.scandir(args.image_directory), key=lambda e: e.name):
+        im, _ = gm.load_image(entry.path)
+        reference = reference_predictor(im)['instances']
+        candidate = candidate_predictor(im)['instances']
+        reports[entry.name] = compare_instances(reference, candidate)
+    summary = summarize(reports)
+    print(f'{"class":<8}{"matches":>9}{"count diff":>12}{"box IoU min/mean":>20}{"mask IoU min/mean":>20}'
+          f'{"score diff max":>16}')
+    for name, stats in summary.items():
+        if not stats['matches']:
+            print(f'{name:<8}{0:>9}{stats["count_mismatches"]:>12}')
+            continue
+        print(f'{name:<8}{stats["matches"]:>9}{stats["count_mismatches"]:>12}'
+              f'{stats["box_iou_min"]:>13.4f}/{stats["box_iou_mean"]:.4f}'
+              f'{stats["mask_iou_min"]:>13.4f}/{stats["mask_iou_mean"]:.4f}'
+              f'{stats["score_diff_max"]:>16.4f}')
+    if args.outfname:
+        with open(args.outfname, 'w') as f:
+            json.dump({'images': reports, 'summary': summary}, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Measures the model time saved by two-stage detection (`gen_metadata.py --detect-size`) on a folder of fish images.
+For every image the model runs on the full image and on the copy downscaled to detect_size, and the report
+compares the time of the model calls, the size of the image the backbone runs on and the fish boxes found.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from detectron2.structures import pairwise_iou
+
+import gen_metadata as gm
+from check_backend_parity import DEFAULT_IMAGE_DIR
+from model_backends import preprocess_image
+
+
+def timed_detection(predictor, im, detect_size, repeat):
+    """
+    Runs the detection of gen_metadata on im repeat times.
+    Returns:
+        insts -- Instances of the last run, in im coordinates.
+        seconds -- fastest of the runs.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        insts = gm.predict_downscaled(predictor, im, detect_size)
+        seconds.append(time.perf_counter() - start)
+    return insts, min(seconds)
+
+
+def compare_image(predictor, file_path, detect_size, repeat):
+    """
+    Compares full size and downscaled detection on one image.
+    """
+    im, _ = gm.load_image(file_path)
+    full, full_time = timed_detection(predictor, im, None, repeat)
+    small, small_time = timed_detection(predictor, im, detect_size, repeat)
+    full_fish, small_fish = gm.class_index(full)[0], gm.class_index(small)[0]
+    fish_iou = []
+    if len(full_fish) and len(small_fish):
+        fish_iou = pairwise_iou(full_fish.pred_boxes, small_fish.pred_boxes).max(dim=1)[0].tolist()
+    # Height and width of the image the backbone runs on
+    full_input = preprocess_image(im, predictor.input_format, predictor.aug)
+    small_input = preprocess_image(gm.downscale(im, detect_size), predictor.input_format, predictor.aug,
+                                   upsample=False)
+    return {'input_size': [list(full_input.shape[1:]), list(small_input.shape[1:])],
+            'fish_count': [len(full_fish), len(small_fish)],
+            'fish_box_iou': fish_iou,
+            'seconds': [full_time, small_time]}
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Time detection on downscaled images against full size detection.')
+    parser.add_argument('image_directory', nargs='?', default=DEFAULT_IMAGE_DIR,
+                        help='Directory of fish images to compare on.')
+    parser.add_argument('--detect-size', type=int, default=640,
+                        help='Longest side of the downscaled image detection runs on.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs per image, the fastest is reported.')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='Device used for the model.')
+    parser.add_argument('--outfname',
+                        help='Output filename for the full per image report in JSON.')
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    predictor = gm.init_model(device=args.device)
+    reports = {}
+    for entry in sorted(os.scandir(args.image_directory), key=lambda e: e.name):
+        reports[entry.name] = compare_image(predictor, entry.path, args.detect_size, args.repeat)
+    if not reports:
+        return
+    fish_count = np.mean([r['fish_count'][0] == r['fish_count'][1] for r in reports.values()])
+    box_iou = [v for r in reports.values() for v in r['fish_box_iou']]
+    full_time = np.mean([r['seconds'][0] for r in reports.values()])
+    small_time = np.mean([r['seconds'][1] for r in reports.values()])
+    print(f'Images compared:            {len(reports)}')
+    print(f'fish_count agreement:       {fish_count:.2%}')
+    if box_iou:
+        print(f'fish box IoU min/mean:      {min(box_iou):.4f}/{np.mean(box_iou):.4f}')
+    print(f'model seconds full/{args.detect_size}:  {full_time:.3f}/{small_time:.3f} '
+          f'({full_time / small_time:.2f}x)')
+    if args.outfname:
+        with open(args.outfname, 'w') as f:
+            json.dump(reports, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Measures the pixel analysis time of the fish of an image (`gen_metadata.py --multiple-fish --fish-workers N`)
+for several numbers of worker threads on a folder of fish images.
+The model runs once per image, then the pixel analysis of the fish kept by --multiple-fish is timed on each
+number of workers. Threads only help on images with several fish and on a machine with several cores.
+"""
+import argparse
+import json
+import os
+import time
+from functools import partial
+
+import numpy as np
+
+import gen_metadata as gm
+from check_backend_parity import DEFAULT_IMAGE_DIR
+
+
+def selected_fish(insts):
+    """
+    Returns the list of single fish Instances gen_metadata analyses with multiple_fish.
+    """
+    fish = gm.class_index(insts)[0]
+    fish = fish[fish.scores > .3]
+    fish = fish[gm.select_fish(fish)]
+    return [fish[i] for i in range(len(fish))]
+
+
+def timed_analysis(file_path, im_gray, fish, workers, detect_size, repeat):
+    """
+    Runs the pixel analysis of every fish on workers threads repeat times.
+    Returns:
+        seconds -- fastest of the runs.
+    """
+    # Size features are measured on an assumed scale, the time does not depend on its value
+    analyze = partial(gm.fish_pixel_analysis, im_gray=im_gray, file_path=file_path, scale=1.,
+                      features=set(gm.FEATURE_GROUPS), detect_size=detect_size)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gm.map_fish(analyze, fish, workers)
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Time the pixel analysis of the fish of each image on '
+                                                 'several numbers of worker threads.')
+    parser.add_argument('image_directory', nargs='?', default=DEFAULT_IMAGE_DIR,
+                        help='Directory of fish images to time on.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1],
+                        help='Numbers of worker threads to time, the first one being the reference.')
+    parser.add_argument('--detect-size', type=int, default=None,
+                        help='Longest side of the downscaled image detection runs on, as in gen_metadata.py.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs per image, the fastest is reported.')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='Device used for the model.')
+    parser.add_argument('--outfname',
+                        help='Output filename for the full per image report in JSON.')
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    predictor = gm.init_model(device=args.device)
+    reports = {}
+    for entry in sorted(os.scandir(args.image_directory), key=lambda e: e.name):
+        im, im_gray = gm.load_image(entry.path)
+        fish = selected_fish(gm.predict_downscaled(predictor, im, args.detect_size))
+        reports[entry.name] = {'fish_count': len(fish),
+                               'seconds': [timed_analysis(entry.path, im_gray, fish, workers, args.detect_size,
+                                                          args.repeat) for workers in args.workers]}
+    if not reports:
+        return
+    fish_count = [r['fish_count'] for r in reports.values()]
+    seconds = np.sum([r['seconds'] for r in reports.values()], axis=0)
+    print(f'Images timed:               {len(reports)} ({sum(fish_count)} fish, '
+          f'{sum(c > 1 for c in fish_count)} images with several fish)')
+    print(f'Cores:                      {os.cpu_count()}')
+    for workers, total in zip(args.workers, seconds):
+        print(f'{workers:>3} workers total seconds: {total:.3f} ({seconds[0] / total:.2f}x)')
+    if args.outfname:
+        with open(args.outfname, 'w') as f:
+            json.dump(reports, f)
+
+
+if __name__ == '__main__':
+    main()
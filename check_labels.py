@@ -7,7 +7,7 @@ from torch.multiprocessing import Pool
 import pandas as pd
 import numpy as np
 from PIL import Image
-from functools import partial
+from functools import partial, lru_cache
 import matplotlib.pyplot as plt
 import pprint
 from copy import copy
@@ -48,15 +48,19 @@ synonyms = {
 }
 
 
-def init_model():
+# Cached so that every label in a run shares one loaded predictor
+@lru_cache(maxsize=2)
+def init_model(weights=os.path.join('output', 'model_final_ocr.pth'), device=None,
+               num_classes=5):
     cfg = get_cfg()
     cfg.merge_from_file("config/mask_rcnn_R_50_FPN_3x.yaml")
     # NOTE THIS SETTING
     # was 5 when I trained current model so has to stay 5 unless retrained
-    cfg.MODEL.ROI_HEADS.NUM_CLASSES = 5
-    cfg.MODEL.WEIGHTS = os.path.join(
-        cfg.OUTPUT_DIR, "model_final_ocr.pth")
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = num_classes
+    cfg.MODEL.WEIGHTS = weights
     cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.3
+    if device:
+        cfg.MODEL.DEVICE = device
     predictor = DefaultPredictor(cfg)
     return predictor
 
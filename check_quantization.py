@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Measures the accuracy and speed of a quantized model against the float model on a folder of fish images.
+For every image both models go through the full metadata generation, and the report compares fish_count,
+eye detection and the IoU of the final fish masks written to the metadata (after pixel analysis), along with
+the time spent per image.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import gen_metadata as gm
+from check_backend_parity import mask_iou
+from mask_codecs import decode_rle_records
+from model_backends import QUANTIZE_MODES
+
+
+def timed_metadata(file_path, visfname, quantize):
+    """
+    Runs the model and the metadata generation on one image, with the fish masks encoded as RLE.
+    Returns:
+        results -- metadata dictionary of the image.
+        seconds -- time spent in the model call.
+    """
+    predictor = gm.init_model(device='cpu', quantize=quantize)
+    im, im_gray = gm.load_image(file_path)
+    start = time.perf_counter()
+    insts = predictor(im)['instances']
+    seconds = time.perf_counter() - start
+    results = gm.gen_metadata_from_instances(file_path, im, im_gray, insts, visfname=visfname, device='cpu',
+                                             quantize=quantize, mask_format='rle')
+    return list(results.values())[0], seconds
+
+
+def fish_masks(results):
+    """
+    Decodes the final masks of the fish of a metadata dictionary, as a list of full image boolean masks.
+    """
+    records = [f['mask'] for f in results.get('fish', []) if 'mask' in f]
+    if not records:
+        return []
+    masks = decode_rle_records(records)
+    return [masks[:, :, i].astype(bool) for i in range(len(records))]
+
+
+def compare_masks(reference, candidate):
+    """
+    Returns the IoU of every reference fish mask with the candidate fish mask overlapping it the most.
+    """
+    return [max((mask_iou(ref, cand) for cand in candidate), default=0.0) for ref in reference]
+
+
+def compare_image(file_path, visfname, quantize):
+    """
+    Compares the float and quantized metadata of one image.
+    """
+    float_results, float_time = timed_metadata(file_path, visfname, None)
+    quant_results, quant_time = timed_metadata(file_path, visfname, quantize)
+    float_eyes = [f.get('has_eye', False) for f in float_results.get('fish', [])]
+    quant_eyes = [f.get('has_eye', False) for f in quant_results.get('fish', [])]
+    return {'fish_count': [float_results['fish_count'], quant_results['fish_count']],
+            'has_eye': [float_eyes, quant_eyes],
+            'fish_mask_iou': [float(iou) for iou in compare_masks(fish_masks(float_results),
+                                                                   fish_masks(quant_results))],
+            'seconds': [float_time, quant_time]}
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Compare a quantized model against the float model.')
+    parser.add_argument('image_directory', help='Directory of fish images to compare on.')
+    parser.add_argument('limit', type=int, nargs='?',
+                        help='Limit the number of images compared from the directory')
+    parser.add_argument('--quantize', choices=QUANTIZE_MODES, default='int8',
+                        help='Quantization mode to evaluate.')
+    parser.add_argument('--outfname',
+                        help='Output filename for the full per image report in JSON.')
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    files = sorted(entry.path for entry in os.scandir(args.image_directory))
+    if args.limit:
+        files = files[:args.limit]
+    reports = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        visfname = os.path.join(tmp, 'prediction.png')
+        for file_path in files:
+            try:
+                reports[os.path.basename(file_path)] = compare_image(file_path, visfname, args.quantize)
+            except Exception as e:
+                print(f'{file_path}: Errored out ({e})')
+    if not reports:
+        return
+    fish_count = np.mean([r['fish_count'][0] == r['fish_count'][1] for r in reports.values()])
+    has_eye = np.mean([r['has_eye'][0] == r['has_eye'][1] for r in reports.values()])
+    mask_iou = [v for r in reports.values() for v in r['fish_mask_iou']]
+    float_time = np.mean([r['seconds'][0] for r in reports.values()])
+    quant_time = np.mean([r['seconds'][1] for r in reports.values()])
+    print(f'Images compared:            {len(reports)}')
+    print(f'fish_count agreement:       {fish_count:.2%}')
+    print(f'has_eye agreement:          {has_eye:.2%}')
+    if mask_iou:
+        print(f'fish mask IoU min/mean:     {min(mask_iou):.4f}/{np.mean(mask_iou):.4f}')
+    print(f'model seconds float/{args.quantize}:  {float_time:.3f}/{quant_time:.3f} '
+          f'({float_time / quant_time:.2f}x)')
+    if args.outfname:
+        with open(args.outfname, 'w') as f:
+            json.dump(reports, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Exports the trained Mask R-CNN used by gen_metadata.py for the alternative inference backends.
+The artifact is written next to model_final.pth, where `gen_metadata.py --backend <format>` looks for it.
+"""
+import argparse
+import os
+
+import gen_metadata as gm
+import model_backends
+
+DEFAULT_SAMPLE = os.path.join(gm.root_dir_path, 'gen_metadata_mini', 'image_test', 'JFBM-FISH-0048705.jpg')
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Export the fish detection model for an exported inference backend.')
+    parser.add_argument('format', choices=model_backends.BACKENDS[1:],
+                        help='Backend to export the model for.')
+    parser.add_argument('--weights',
+                        help='Trained weights to export. Defaults to the weights selected by the gen_metadata config.')
+    parser.add_argument('--output',
+                        help='Artifact filename. Defaults to the weights filename with the backend extension.')
+    parser.add_argument('--sample-image', default=DEFAULT_SAMPLE,
+                        help='Fish image used to trace the model.')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='Device the exported model will run on.')
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    weights = args.weights or gm.model_weights_path()
+    output = args.output or model_backends.exported_model_path(weights, args.format)
+    cfg = gm.model_config(weights, args.device)
+    sample, _ = gm.load_image(args.sample_image)
+    if args.format == 'torchscript':
+        model_backends.export_torchscript(cfg, sample, output)
+    elif args.format == 'onnx':
+        model_backends.export_onnx(cfg, sample, output)
+    print(f'Exported {weights} to {output}')
+
+
+if __name__ == '__main__':
+    main()
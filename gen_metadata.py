@@ -5,10 +5,10 @@ import os
 import pprint
 import sys
 import yaml
-from random import shuffle
 import argparse
 
-import gc
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache, partial
 import torch
 import cv2
 import numpy as np
@@ -16,13 +16,16 @@ from detectron2.config import get_cfg
 from detectron2.data import Metadata
 from detectron2.engine import DefaultPredictor
 from detectron2.utils.visualizer import Visualizer
-from detectron2.structures import Boxes, pairwise_iou, pairwise_ioa
+from detectron2.structures import Boxes, Instances, pairwise_iou, pairwise_ioa
 from matplotlib import pyplot as plt
+from PIL import Image
 from scipy import stats
-from skimage import filters, measure
-from skimage.morphology import flood_fill
+from skimage import measure
 from torch.multiprocessing import Pool
 
+from mask_codecs import MASK_FORMATS, encode_freeman, encode_rle, freeman_contour, pack_freeman
+from model_backends import BACKENDS, QUANTIZE_MODES, load_exported_predictor, paste_masks, predict_lazy, quantize_model
+
 # torch.multiprocessing.set_start_method('forkserver')
 
 # Look for the config directory in the same directory as this script
@@ -36,46 +39,132 @@ conf = json.load(open(main_config_path, 'r'))
 ENHANCE = bool(conf['ENHANCE'])
 JOEL = bool(conf['JOEL'])
 IOU_PCT = .02
+NUM_CLASSES = 5
+# Number of distinct predictors (weights/device/flag combinations) kept loaded at once
+PREDICTOR_CACHE_SIZE = int(os.environ.get('DM_PREDICTOR_CACHE_SIZE', 4))
+# Longest side of the prediction visualization, the largest input size of the model
+VIS_SIZE = 1333
+# Padding, as a fraction of the bbox size, around each fish when pixel analysis runs on a crop
+CROP_PAD = .25
+# First step, as a fraction of the bbox size, by which pixel analysis pushes out a bbox side the fish touches
+BBOX_GROW_STEP = .1
+# JPEG decode flags reducing the image by 8, 4 or 2 in the DCT domain, largest reduction first
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2)]
+# Optional groups of per fish properties (see --features); the properties marked * need a scale
+FEATURE_GROUPS = {'brightness': ['foreground', 'background'],
+                  'shape': ['extent', 'eccentricity'],
+                  'convex': ['solidity', 'convex_area*', 'feret_diameter_max*'],
+                  'perimeter': ['perimeter*'],
+                  'size': ['area*', 'cont_length*', 'cont_width*', 'major_axis_length*', 'minor_axis_length*',
+                           'oriented_length*', 'oriented_width*'],
+                  'statistics': ['skew', 'kurtosis', 'std'],
+                  'mask': ['mask']}
 
 with open(mask_config_path, 'r') as f:
     iters = yaml.load(f, Loader=yaml.FullLoader)["SOLVER"]["MAX_ITER"]
 
 
-def init_model(enhance_contrast=ENHANCE, joel=JOEL, device=None):
+def init_model(enhance_contrast=ENHANCE, joel=JOEL, device=None, backend='detectron2', quantize=None):
     """
     Initialize model using config files for RCNN, the trained weights, and other parameters.
+    Predictors are cached, so every image of a run shares the one loaded for its weights.
 
+    Parameters:
+        backend -- 'detectron2' to build the model from the weights, or the name of an exported
+                   backend (see model_backends) to load the artifact stored next to them.
+        quantize -- None for the float model, or 'int8' for a dynamically quantized CPU model.
     Returns:
-        predictor -- DefaultPredictor(**configs).
+        predictor -- DefaultPredictor(**configs) or an equivalent exported predictor.
+    """
+    weights = model_weights_path(enhance_contrast, joel)
+    return load_predictor(weights, device, bool(enhance_contrast), bool(joel), NUM_CLASSES, backend, quantize)
+
+
+def model_weights_path(enhance_contrast=ENHANCE, joel=JOEL):
+    """
+    Returns the path of the trained weights matching the enhance/JOEL flags.
+    """
+    output_dir = 'output'
+    if not joel:
+        output_dir += '/non_enhanced' if not enhance_contrast else '/enhanced'
+    return os.path.join(root_dir_path, output_dir, 'model_final.pth')
+
+
+def model_config(weights, device=None, num_classes=NUM_CLASSES):
+    """
+    Builds the detectron2 config of the Mask R-CNN for the given weights.
     """
     cfg = get_cfg()
     cfg.merge_from_file(mask_config_path)
-    cfg.MODEL.ROI_HEADS.NUM_CLASSES = 5
-    if not joel:
-        cfg.OUTPUT_DIR += f"/non_enhanced" if not enhance_contrast else f"/enhanced"
-        # cfg.OUTPUT_DIR += f"/non_enhanced_{iters}" if not enhance_contrast else f"/enhanced_{iters}"
-    cfg.MODEL.WEIGHTS = os.path.join(os.path.join(root_dir_path, cfg.OUTPUT_DIR), "model_final.pth")
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = num_classes
+    cfg.MODEL.WEIGHTS = weights
     cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.3
     if device:
        cfg.MODEL.DEVICE = device
-    predictor = DefaultPredictor(cfg)
-    
+    return cfg
+
+
+@lru_cache(maxsize=PREDICTOR_CACHE_SIZE)
+def load_predictor(weights, device, enhance_contrast, joel, num_classes, backend='detectron2', quantize=None):
+    """
+    Builds a predictor for the given weights. Results are kept in an LRU cache keyed by
+    every argument, so the config is merged and the weights are read once per combination.
+
+    Parameters:
+        weights -- path to the trained model_final.pth.
+        device -- 'cpu', 'cuda' or None for the config default.
+        enhance_contrast -- whether the weights were trained on CLAHE enhanced images.
+        joel -- whether the weights are the original INHS only model.
+        num_classes -- number of classes the weights were trained with.
+        backend -- inference backend, one of model_backends.BACKENDS.
+        quantize -- None, or one of model_backends.QUANTIZE_MODES to quantize the detectron2 model.
+    Returns:
+        predictor -- DefaultPredictor(**configs) or an equivalent exported predictor.
+    """
+    if quantize and (backend != 'detectron2' or device == 'cuda'):
+        raise ValueError('Quantized models are only supported with the detectron2 backend on the CPU')
+    if backend != 'detectron2':
+        return load_exported_predictor(weights, backend, device)
+    if quantize:
+        device = 'cpu'
+    predictor = DefaultPredictor(model_config(weights, device, num_classes))
+    if quantize:
+        predictor.model = quantize_model(predictor.model, quantize)
+
     return predictor
 
 
-def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_fish=False, device=None, maskfname=None,
-                 visfname=None):
+def decode_flag(file_path, decode_size=None):
     """
-    Generates metadata of an image and stores attributes into a Dictionary.
+    Returns the cv2.imread flag decoding file_path at the largest reduction whose longest side is still at
+    least decode_size, or IMREAD_COLOR for a full resolution decode. Only the image header is read.
+    """
+    if not decode_size:
+        return cv2.IMREAD_COLOR
+    with Image.open(file_path) as img:
+        longest = max(img.size)
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if longest // factor >= decode_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def load_image(file_path, enhance_contrast=ENHANCE, decode_size=None):
+    """
+    Decodes an image once and derives its grayscale version from it, applying CLAHE to both when requested.
 
     Parameters:
         file_path -- string of path to image file.
+        enhance_contrast -- whether to apply contrast enhancement.
+        decode_size -- when set, JPEGs are decoded at a 1/2, 1/4 or 1/8 reduced resolution that keeps the
+                       longest side at least decode_size. All the metadata is then in reduced pixels.
     Returns:
-        {file_name: results} -- dictionary of file and associated results.
+        im -- BGR image passed to the model.
+        im_gray -- grayscale image used for pixel analysis.
     """
-    predictor = init_model(device=device)
-    im = cv2.imread(file_path)
-    im_gray = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+    im = cv2.imread(file_path, decode_flag(file_path, decode_size))
+    im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
     if enhance_contrast:
         lab = cv2.cvtColor(im, cv2.COLOR_BGR2LAB)
 
@@ -94,45 +183,235 @@ def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_
 
         clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
         im_gray = clahe.apply(im_gray)
+    return im, im_gray
+
+
+def downscale(im, detect_size):
+    """
+    Returns im downscaled so its longest side is at most detect_size (im itself when it already fits).
+    """
+    if not detect_size or max(im.shape[:2]) <= detect_size:
+        return im
+    factor = detect_size / max(im.shape[:2])
+    return cv2.resize(im, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+
+def rescale_instances(insts, shape):
+    """
+    Maps predicted boxes to an image of the given (height, width).
+    The masks are kept as predicted (ROI or image resolution); see instance_mask.
+    """
+    if tuple(insts.image_size) == tuple(shape):
+        return insts
+    scaled = Instances(tuple(shape), **insts.get_fields())
+    scaled.pred_boxes = insts.pred_boxes.clone()
+    scaled.pred_boxes.scale(shape[1] / insts.image_size[1], shape[0] / insts.image_size[0])
+    scaled.pred_boxes.clip(tuple(shape))
+    return scaled
+
+
+def predict_downscaled(predictor, im, detect_size=None):
+    """
+    Runs detection on a copy of im downscaled to detect_size and maps the boxes back to im's coordinates.
+    The copy is not enlarged back to the model's test size (shortest side 800 pixels), so a detect_size
+    below it also shrinks the image the backbone runs on.
+
+    Returns:
+        insts -- detectron2 Instances with boxes in im coordinates and masks at ROI resolution.
+    """
+    insts = predict_lazy(predictor, [downscale(im, detect_size)], upsample=not detect_size)[0]
+    return rescale_instances(insts, im.shape[:2])
+
+
+def instance_mask(inst, shape, window=None):
+    """
+    Returns the predicted mask of a single instance as a boolean array of the given image shape, or of its
+    (left, top, right, bottom) window of the image when one is given.
+    ROI resolution masks are pasted into the image here, so only the instances that are used get a mask.
+    """
+    left, top, right, bottom = window or (0, 0, shape[1], shape[0])
+    if inst.pred_masks.dim() == 4:
+        return paste_masks(inst, (bottom - top, right - left), offset=(left, top))[0].cpu().numpy()
+    mask = inst.pred_masks[0].cpu().numpy()
+    if mask.shape != tuple(shape[:2]):
+        mask = cv2.resize(mask.astype(np.uint8), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST) > 0
+    return mask[top:bottom, left:right]
+
+
+def mask_window(bbox, shape, margin=1):
+    """
+    Returns the (left, top, right, bottom) window of an image of the given shape holding the predicted mask
+    of a fish with the given bbox (the mask may spill a pixel over the rounded box).
+    """
+    return (max(0, bbox[0] - margin), max(0, bbox[1] - margin),
+            min(shape[1], bbox[2] + margin), min(shape[0], bbox[3] + margin))
+
+
+def full_mask(mask, offset, shape):
+    """
+    Expands a mask crop whose top left corner is at the (x, y) offset to a mask of the image shape.
+    """
+    full = np.zeros(shape[:2], dtype=mask.dtype)
+    full[offset[1]:offset[1] + mask.shape[0], offset[0]:offset[0] + mask.shape[1]] = mask
+    return full
+
+
+def draw_predictions(im, insts, metadata, detect_size=None):
+    """
+    Draws the predictions on im downscaled to VIS_SIZE, or to detect_size when detection ran on a smaller copy.
+    ROI resolution masks are pasted at the drawing size, so only the selected fish get full resolution masks
+    (see instance_mask). Masks already pasted by the predictor are drawn at their own resolution.
+    """
+    if insts.pred_masks.dim() == 3:
+        height, width = insts.pred_masks.shape[1:]
+        if (height, width) != im.shape[:2]:
+            im = cv2.resize(im, (width, height), interpolation=cv2.INTER_AREA)
+    else:
+        im = downscale(im, min(detect_size or VIS_SIZE, VIS_SIZE))
+    insts = rescale_instances(insts, im.shape[:2])
+    if insts.pred_masks.dim() == 4:
+        insts = Instances(insts.image_size, **insts.get_fields())
+        insts.pred_masks = paste_masks(insts, im.shape)
+    visualizer = Visualizer(im[:, :, ::-1], metadata=metadata, scale=1.0)
+    return visualizer.draw_instance_predictions(insts.to('cpu'))
+
+
+def class_index(insts):
+    """
+    Splits the predictions by class once per image.
+
+    Returns:
+        by_class -- list indexed by class id (fish, ruler, eye, two, three) of the Instances of that class.
+    """
+    classes = insts.pred_classes
+    return [insts[classes == k] for k in range(NUM_CLASSES)]
+
+
+def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_fish=False, device=None, maskfname=None,
+                 visfname=None, backend='detectron2', quantize=None, detect_size=None, decode_size=None, features=None,
+                 mask_format='freeman', fish_workers=None):
+    """
+    Generates metadata of an image and stores attributes into a Dictionary.
+
+    Parameters:
+        file_path -- string of path to image file.
+        detect_size -- when set, detection runs on a copy downscaled to this longest side and the
+                       pixel analysis on full resolution crops around each fish (see predict_downscaled).
+        decode_size -- when set, the image is decoded at a reduced resolution (see load_image).
+        features -- names of the FEATURE_GROUPS to compute for each fish, all of them when None.
+        mask_format -- encoding of the fish masks, one of MASK_FORMATS (see mask_codecs).
+        fish_workers -- number of threads running the pixel analysis of the fish, one per core when None.
+    Returns:
+        {file_name: results} -- dictionary of file and associated results.
+    """
+    predictor = init_model(device=device, backend=backend, quantize=quantize)
+    im, im_gray = load_image(file_path, enhance_contrast, decode_size)
+    insts = predict_downscaled(predictor, im, detect_size)
+    return gen_metadata_from_instances(file_path, im, im_gray, insts, enhance_contrast=enhance_contrast,
+                                       visualize=visualize, multiple_fish=multiple_fish, device=device,
+                                       maskfname=maskfname, visfname=visfname, backend=backend,
+                                       quantize=quantize, detect_size=detect_size, features=features,
+                                       mask_format=mask_format, fish_workers=fish_workers, predictor=predictor)
+
+
+def gen_metadata_batch(paths, batch_size=4, enhance_contrast=ENHANCE, multiple_fish=False, device=None,
+                       backend='detectron2', quantize=None, detect_size=None, decode_size=None, features=None,
+                       mask_format='freeman', fish_workers=None):
+    """
+    Generates metadata for several images, running the model on batch_size images per forward pass.
+    Each image's instances then go through the same post-processing as gen_metadata.
+
+    Parameters:
+        paths -- list of image file paths.
+        batch_size -- number of images stacked into one model call.
+    Returns:
+        results -- list of {file_name: results} dictionaries in the order of paths.
+    """
+    predictor = init_model(device=device, backend=backend, quantize=quantize)
+    post_process = partial(gen_metadata_from_instances, enhance_contrast=enhance_contrast,
+                           multiple_fish=multiple_fish, device=device, backend=backend, quantize=quantize,
+                           detect_size=detect_size, features=features, mask_format=mask_format,
+                           fish_workers=fish_workers, predictor=predictor)
+    results = []
+    for start in range(0, len(paths), batch_size):
+        batch_paths = paths[start:start + batch_size]
+        # Results of the batch in the order of its paths, the images that fail to load included
+        batch_results = [None] * len(batch_paths)
+        loaded = []
+        for j, file_path in enumerate(batch_paths):
+            try:
+                loaded.append((j, file_path) + load_image(file_path, enhance_contrast, decode_size))
+            except Exception as e:
+                print(f'{file_path}: Errored out ({e})')
+                batch_results[j] = {file_path: {'errored': True}}
+        try:
+            outputs = predict_lazy(predictor, [downscale(im, detect_size) for _, _, im, _ in loaded],
+                                   upsample=not detect_size) if loaded else []
+        except Exception as e:
+            # Fall back to one image at a time so a single bad image does not fail the batch
+            print(f'Batch starting at {loaded[0][1]}: Errored out ({e}), retrying images individually')
+            outputs = None
+        for k, (j, file_path, im, im_gray) in enumerate(loaded):
+            try:
+                if outputs is None:
+                    insts = predict_downscaled(predictor, im, detect_size)
+                else:
+                    insts = rescale_instances(outputs[k], im.shape[:2])
+                batch_results[j] = post_process(file_path, im, im_gray, insts)
+            except Exception as e:
+                print(f'{file_path}: Errored out ({e})')
+                batch_results[j] = {file_path: {'errored': True}}
+        results.extend(batch_results)
+    return results
+
+
+def gen_metadata_from_instances(file_path, im, im_gray, insts, enhance_contrast=ENHANCE, visualize=False,
+                                multiple_fish=False, device=None, maskfname=None, visfname=None, backend='detectron2',
+                                quantize=None, detect_size=None, features=None, mask_format='freeman',
+                                fish_workers=None, predictor=None):
+    """
+    Turns the model predictions for one image into its metadata Dictionary.
+    With detect_size set, pixel analysis runs on padded full resolution crops around each fish.
+    Only the per fish properties of the FEATURE_GROUPS named in features (all when None) are computed,
+    and the fish masks are encoded in mask_format. The pixel analysis of the fish runs on fish_workers
+    threads (see map_fish). The eye of a fish without one is looked for in its upscaled crop with predictor,
+    which is loaded from the model arguments when not given.
+
+    Parameters:
+        file_path -- string of path to image file.
+        im -- BGR image the predictions were made on.
+        im_gray -- grayscale image used for pixel analysis.
+        insts -- detectron2 Instances predicted for im.
+    Returns:
+        {file_name: results} -- dictionary of file and associated results.
+    """
     metadata = Metadata(evaluator_type='coco', image_root='.',
                         json_file='',
                         name='metadata',
                         thing_classes=['fish', 'ruler', 'eye', 'two', 'three'],
                         thing_dataset_id_to_contiguous_id={1: 0, 2: 1, 3: 2, 4: 3, 5: 4}
                         )
-    output = predictor(im)
-    insts = output['instances']
-    selector = insts.pred_classes == 0
-    selector = selector.cumsum(axis=0).cumsum(axis=0) == 1
     results = {}
+    features = set(FEATURE_GROUPS if features is None else features)
     file_name = file_path.split('/')[-1]
-    for i in range(1, 5):
-        temp = insts.pred_classes == i
-        selector += temp.cumsum(axis=0).cumsum(axis=0) == 1
-    fish = insts[insts.pred_classes == 0]
-    if len(fish):
-        results['fish'] = []
-        if not multiple_fish:
-            results['fish'].append({})
-        else:
-            for _ in range(len(fish)):
-                results['fish'].append({})
-    else:
+    by_class = class_index(insts)
+    fish = by_class[0]
+    if not len(fish):
         fish = None
     results['has_fish'] = bool(fish)
     try:
-        ruler = insts[insts.pred_classes == 1][0]
+        ruler = by_class[1][0]
         ruler_bbox = list(ruler.pred_boxes.tensor.cpu().numpy()[0])
         results['ruler_bbox'] = [round(x) for x in ruler_bbox]
     except:
         ruler = None
     results['has_ruler'] = bool(ruler)
     try:
-        two = insts[insts.pred_classes == 3][0]
+        two = by_class[3][0]
     except:
         two = None
     try:
-        three = insts[insts.pred_classes == 4][0]
+        three = by_class[4][0]
     except:
         three = None
     if ruler and two and three:
@@ -141,8 +420,7 @@ def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_
         results['unit'] = 'cm'
     else:
         scale = None
-    visualizer = Visualizer(im[:, :, ::-1], metadata=metadata, scale=1.0)
-    vis = visualizer.draw_instance_predictions(insts.to('cpu'))
+    vis = draw_predictions(im, insts, metadata, detect_size)
     f_name = file_name.split('.')[0]
     if visualize:
         cv2.imshow('prediction', np.array(vis.get_image()[:, :, ::-1], dtype=np.uint8))
@@ -156,55 +434,28 @@ def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_
         print(file_name)
         visfname = f'{dirname}/gen_prediction_{f_name}.png'
     cv2.imwrite(visfname, vis.get_image()[:, :, ::-1])
-    skippable_fish = []
     fish_length = 0
     if fish:
-        try:
-            eyes = insts[insts.pred_classes == 2]
-        except:
-            eyes = None
+        eyes = by_class[2]
 
         fish = fish[fish.scores > .3]
         fish_length = len(fish)
         if not multiple_fish:
             fish = fish[fish.scores.argmax().item()]
-        for i in range(len(fish)):
+        else:
+            fish = fish[select_fish(fish)]
+        results['fish'] = []
+        eye_indices = select_eyes(fish, eyes)
+        analyze = partial(fish_pixel_analysis, im_gray=im_gray, file_path=file_path, scale=scale, features=features,
+                          mask_format=mask_format, detect_size=detect_size, visualize=visualize)
+        # plt.show only works from the main thread
+        analyses = map_fish(analyze, [fish[i] for i in range(len(fish))], 1 if visualize else fish_workers)
+        for i, (fish_results, bbox, mask, offset, fish_features) in enumerate(analyses):
             curr_fish = fish[i]
-            if multiple_fish:
-                if i in skippable_fish:
-                    continue
-                fish_ols = [overlap_fish(curr_fish, fish[j]) for j in range(i + 1, len(fish))]
-                for j in range(len(fish_ols)):
-                    if i + j + 1 not in skippable_fish and fish_ols[j] > IOU_PCT:
-                        results['fish'].pop(i + j + 1 - len(skippable_fish))
-                        skippable_fish.append(i + j + 1)
-                    else:
-                        print(f"Fish {i} and Fish {i + j + 1} do not overlap!")
-            if eyes:
-                eye_ols = [overlap(curr_fish, eyes[j]) for j in
-                           range(len(eyes))]
-                eye = None
-                if not all(ol == 0 for ol in eye_ols):
-                    full = [i for i in range(
-                        len(eye_ols)) if eye_ols[i] >= .95]
-
-                    # if multiple eyes with 95% or greater overlap, pick highest confidence
-                    if len(full) > 1:
-                        eye = eyes[full]
-                        eye = eye[eye.scores.argmax().item()]
-                    else:
-                        max_ind = max(range(len(eye_ols)),
-                                      key=eye_ols.__getitem__)
-                        eye = eyes[max_ind]
-            else:
-                eye = None
-            bbox = [round(x) for x in curr_fish.pred_boxes.tensor.cpu().numpy().astype('float64')[0]]
+            eye = eyes[eye_indices[i]] if eye_indices[i] >= 0 else None
+            results['fish'].append(fish_results)
             need_scaling = False
-            detectron_mask = curr_fish.pred_masks[0].cpu().numpy()
-            val = adaptive_threshold(bbox, im_gray)
-            bbox, mask, pixel_anal_failed = gen_mask(bbox, file_path,
-                                                     file_name, im_gray, val, detectron_mask)
-            centroid, evecs, cont_length, cont_width, length, width, area = pca(mask, scale)
+            centroid, evecs = fish_features.centroid.astype(int), fish_features.axes
             major, minor = evecs[0], evecs[1]
 
             if not np.count_nonzero(mask):
@@ -212,83 +463,20 @@ def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_
                 results['errored'] = True
             else:
                 if maskfname:
-                    mask_uint8 = np.where(mask == 1, 255, 0).astype(np.uint8)
+                    mask_uint8 = np.where(full_mask(mask, offset, im_gray.shape) == 1, 255, 0).astype(np.uint8)
                     cv2.imwrite(maskfname, mask_uint8)
-                im_crop = im_gray[bbox[1]:bbox[3], bbox[0]:bbox[2]].reshape(-1)
-                mask_crop = mask[bbox[1]:bbox[3], bbox[0]:bbox[2]].reshape(-1)
-                mask_coords = np.argwhere(mask != 0)[:, [1, 0]]
-                fground = im_crop[np.where(mask_crop)]
-                bground = im_crop[np.where(np.logical_not(mask_crop))]
-                results['fish'][i]['foreground'] = {}
-                results['fish'][i]['foreground']['mean'] = np.mean(fground)
-                results['fish'][i]['foreground']['std'] = np.std(fground)
-                results['fish'][i]['background'] = {}
-                results['fish'][i]['background']['mean'] = np.mean(bground)
-                results['fish'][i]['background']['std'] = np.std(bground)
-                results['fish'][i]['bbox'] = list(bbox)
-                results['fish'][i]['pixel_analysis_failed'] = pixel_anal_failed
-                start, code = encoded_mask(mask)
-                region = measure.regionprops(mask)[0]
-                if visualize:
-                    fig, ax = plt.subplots()
-                    ax.imshow(mask, cmap=plt.cm.gray)
-                    y0, x0 = region.centroid
-                    orientation = region.orientation
-                    x1 = x0 + math.cos(orientation) * 0.5 * \
-                         region.axis_minor_length
-                    y1 = y0 - math.sin(orientation) * 0.5 * \
-                         region.axis_minor_length
-                    x2 = x0 - math.sin(orientation) * 0.5 * \
-                         region.axis_major_length
-                    y2 = y0 - math.cos(orientation) * 0.5 * \
-                         region.axis_major_length
-
-                    ax.plot((x0, x1), (y0, y1), '-r')
-                    ax.plot((x0, x2), (y0, y2), '-b')
-                    ax.plot(x0, y0, '.g', markersize=15)
-
-                    minr, minc, maxr, maxc = region.bbox
-                    bx = (minc, maxc, maxc, minc, minc)
-                    by = (minr, minr, maxr, maxr, minr)
-                    ax.plot(bx, by, '-b', linewidth=2.5)
-                    plt.show()
-
-                results['fish'][i]['extent'] = region.extent
-                results['fish'][i]['eccentricity'] = region.eccentricity
-                results['fish'][i]['solidity'] = region.solidity
-                results['fish'][i]['skew'] = list(stats.skew(mask_coords))
-                results['fish'][i]['kurtosis'] = list(
-                    stats.kurtosis(mask_coords))
-                results['fish'][i]['std'] = list(np.std(mask_coords, axis=0))
-                results['fish'][i]['mask'] = {}
-                results['fish'][i]['mask']['start_coord'] = list(start)
-                results['fish'][i]['mask']['encoding'] = code
-
                 # upscale fish and then rerun
                 if eye is None:
                     need_scaling = True
                     factor = 4
-                    eye_center, side, clock_val = upscale(
-                        im, bbox, f_name, factor, device)
+                    if predictor is None:
+                        predictor = init_model(device=device, backend=backend, quantize=quantize)
+                    eye_center, side, clock_val = upscale(im, bbox, f_name, factor, predictor)
                     if eye_center is not None and side is not None:
                         results['fish'][i]['eye_center'] = eye_center
                         results['fish'][i]['side'] = side
                         results['fish'][i]['clock_value'] = clock_val
                         eye = 1  # placeholder, change to something more useful
-                if scale:
-                    results['fish'][i]['cont_length'] = cont_length
-                    results['fish'][i]['cont_width'] = cont_width
-                    results['fish'][i]['area'] = area
-                    results['fish'][i]['feret_diameter_max'] = region.feret_diameter_max / scale
-                    results['fish'][i]['major_axis_length'] = region.major_axis_length / scale
-                    results['fish'][i]['minor_axis_length'] = region.minor_axis_length / scale
-                    results['fish'][i]['convex_area'] = region.convex_area / \
-                                                        (scale ** 2)
-                    results['fish'][i]['perimeter'] = measure.perimeter(
-                        mask, neighbourhood=8) / scale
-                    results['fish'][i]['oriented_length'] = length / scale
-                    results['fish'][i]['oriented_width'] = width / scale
-                results['fish'][i]['centroid'] = centroid.tolist()
             results['fish'][i]['has_eye'] = bool(eye)
             if eye and not need_scaling:
                 eye_center = [round(x) for x in eye.pred_boxes.get_centers()[0].cpu().numpy()]
@@ -301,7 +489,7 @@ def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_
                     results['fish'][i]['side'] = 'left'
                 else:
                     results['fish'][i]['side'] = 'right'
-                snout_vec = major
+                snout_vec = find_snout_vec(centroid, eye_center, mask, offset)
                 if snout_vec is None:
                     results['fish'][i]['clock_value'] = \
                         clock_value(major, file_name)
@@ -310,29 +498,141 @@ def gen_metadata(file_path, enhance_contrast=ENHANCE, visualize=False, multiple_
                         clock_value(snout_vec, file_name)
                 results['fish'][i]['primary_axis'] = list(major)
                 results['fish'][i]['score'] = float(curr_fish.scores[0].cpu())
-    results['fish_count'] = len(insts[(insts.pred_classes == 0).logical_and(insts.scores > 0.3)]) - \
-                            len(skippable_fish) if multiple_fish else int(results['has_fish'])
+    results['fish_count'] = len(fish) if multiple_fish and fish is not None else int(results['has_fish'])
     results['detected_fish_count'] = fish_length
     return {f_name: results}
 
 
-def gen_metadata_upscale(file_path, fish, device=None):
-    gc.collect()
-    torch.cuda.empty_cache()
-    predictor = init_model(device=device)
+def fish_pixel_analysis(fish, im_gray, file_path, scale, features, mask_format='freeman', detect_size=None,
+                        visualize=False):
+    """
+    Pixel analysis of one fish: refines its mask from the grayscale image and measures the selected features.
+    Only reads im_gray, so several fish of an image can be analysed at once (see map_fish).
+    Parameters:
+        fish -- single fish Instances.
+        im_gray -- grayscale image used for pixel analysis.
+        scale -- pixels per cm, or None without a ruler.
+        features -- set of the FEATURE_GROUPS to compute.
+    Returns:
+        fish_results -- dictionary of the fish properties, empty when the mask failed.
+        bbox -- bbox of the fish after pixel analysis.
+        mask, offset -- mask crop of the fish and the (x, y) position of its top left corner.
+        fish_features -- FishFeatures of the mask.
+    """
+    file_name = file_path.split('/')[-1]
+    bbox = [round(x) for x in fish.pred_boxes.tensor.cpu().numpy().astype('float64')[0]]
+    # masks are crops of the image, with the (x, y) offset of their top left corner
+    window = mask_window(bbox, im_gray.shape)
+    detectron_mask = instance_mask(fish, im_gray.shape, window)
+    if detect_size:
+        bbox, mask, offset, pixel_anal_failed = gen_mask_cropped(bbox, file_path, file_name, im_gray,
+                                                                 detectron_mask, window[:2])
+    else:
+        val = adaptive_threshold(bbox, im_gray)
+        bbox, mask, offset, pixel_anal_failed = gen_mask(bbox, file_path, file_name, im_gray, val,
+                                                         detectron_mask, detectron_offset=window[:2])
+    fish_features = FishFeatures(mask, offset)
+    fish_results = {}
+    if np.count_nonzero(mask):
+        if 'brightness' in features:
+            im_crop = im_gray[bbox[1]:bbox[3], bbox[0]:bbox[2]].reshape(-1)
+            mask_crop = mask[bbox[1] - offset[1]:bbox[3] - offset[1],
+                             bbox[0] - offset[0]:bbox[2] - offset[0]].reshape(-1)
+            fground = im_crop[np.where(mask_crop)]
+            bground = im_crop[np.where(np.logical_not(mask_crop))]
+            fish_results['foreground'] = {}
+            fish_results['foreground']['mean'] = np.mean(fground)
+            fish_results['foreground']['std'] = np.std(fground)
+            fish_results['background'] = {}
+            fish_results['background']['mean'] = np.mean(bground)
+            fish_results['background']['std'] = np.std(bground)
+        fish_results['bbox'] = list(bbox)
+        fish_results['pixel_analysis_failed'] = pixel_anal_failed
+        if visualize:
+            region = fish_features.region
+            fig, ax = plt.subplots()
+            ax.imshow(mask, cmap=plt.cm.gray)
+            y0, x0 = region.centroid
+            orientation = region.orientation
+            x1 = x0 + math.cos(orientation) * 0.5 * \
+                 region.axis_minor_length
+            y1 = y0 - math.sin(orientation) * 0.5 * \
+                 region.axis_minor_length
+            x2 = x0 - math.sin(orientation) * 0.5 * \
+                 region.axis_major_length
+            y2 = y0 - math.cos(orientation) * 0.5 * \
+                 region.axis_major_length
+
+            ax.plot((x0, x1), (y0, y1), '-r')
+            ax.plot((x0, x2), (y0, y2), '-b')
+            ax.plot(x0, y0, '.g', markersize=15)
+
+            minr, minc, maxr, maxc = region.bbox
+            bx = (minc, maxc, maxc, minc, minc)
+            by = (minr, minr, maxr, maxr, minr)
+            ax.plot(bx, by, '-b', linewidth=2.5)
+            plt.show()
+
+        if 'shape' in features:
+            fish_results['extent'] = fish_features.extent
+            fish_results['eccentricity'] = fish_features.eccentricity
+        if 'convex' in features:
+            fish_results['solidity'] = fish_features.solidity
+        if 'statistics' in features:
+            fish_results['skew'] = fish_features.skew
+            fish_results['kurtosis'] = fish_features.kurtosis
+            fish_results['std'] = fish_features.std
+        if 'mask' in features and mask_format != 'none':
+            fish_results['mask'] = mask_record(mask, offset, im_gray.shape, mask_format)
+        if scale and 'size' in features:
+            cont_length, cont_width, length, width, area = pca(fish_features, scale)[2:]
+            fish_results['cont_length'] = cont_length
+            fish_results['cont_width'] = cont_width
+            fish_results['area'] = area
+            fish_results['major_axis_length'] = fish_features.major_axis_length / scale
+            fish_results['minor_axis_length'] = fish_features.minor_axis_length / scale
+            fish_results['oriented_length'] = length / scale
+            fish_results['oriented_width'] = width / scale
+        if scale and 'convex' in features:
+            fish_results['feret_diameter_max'] = fish_features.feret_diameter_max / scale
+            fish_results['convex_area'] = fish_features.convex_area / (scale ** 2)
+        if scale and 'perimeter' in features:
+            fish_results['perimeter'] = fish_features.perimeter / scale
+        fish_results['centroid'] = fish_features.centroid.astype(int).tolist()
+    return fish_results, bbox, mask, offset, fish_features
+
+
+def map_fish(func, fish, workers=None):
+    """
+    Applies func to every fish on a pool of workers threads (one per core when None) and returns the results
+    in fish order. Threads share the image without copying it, and the OpenCV, numpy and scikit-image
+    routines of the pixel analysis release the GIL.
+    """
+    workers = min(len(fish), workers or os.cpu_count() or 1)
+    if workers <= 1:
+        return [func(f) for f in fish]
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(func, fish))
+
+
+def gen_metadata_upscale(file_path, fish, predictor):
+    """
+    Finds the eye of the main fish in an upscaled fish crop.
+    Parameters:
+        file_path -- name of the crop, for the results key and messages.
+        fish -- upscaled BGR fish crop.
+        predictor -- predictor already loaded for the full image.
+    Returns:
+        {file_name: results} -- dictionary of file and associated results.
+    """
     im = fish
     im_gray = cv2.cvtColor(fish, cv2.COLOR_BGR2GRAY)
-    output = predictor(im)
-    insts = output['instances']
-    selector = insts.pred_classes == 0
-    selector = selector.cumsum(axis=0).cumsum(axis=0) == 1
+    insts = predict_lazy(predictor, [im])[0]
     results = {}
     file_name = file_path.split('/')[-1]
     f_name = file_name.split('.')[0]
-    for i in range(1, 5):
-        temp = insts.pred_classes == i
-        selector += temp.cumsum(axis=0).cumsum(axis=0) == 1
-    fish = insts[insts.pred_classes == 0]
+    by_class = class_index(insts)
+    fish = by_class[0]
     if len(fish):
         results['fish'] = []
         results['fish'].append({})
@@ -340,39 +640,22 @@ def gen_metadata_upscale(file_path, fish, device=None):
         fish = None
     results['has_fish'] = bool(fish)
     if fish:
-        try:
-            eyes = insts[insts.pred_classes == 2]
-        except:
-            eyes = None
+        eyes = by_class[2]
 
         fish = fish[fish.scores > .3]
         fish = fish[fish.scores.argmax().item()]
+        eye_indices = select_eyes(fish, eyes)
         for i in range(len(fish)):
             curr_fish = fish[i]
-            if eyes:
-                eye_ols = [overlap(curr_fish, eyes[j]) for j in
-                           range(len(eyes))]
-                eye = None
-                if not all(ol == 0 for ol in eye_ols):
-                    full = [i for i in range(
-                        len(eye_ols)) if eye_ols[i] >= .95]
-
-                    # if multiple eyes with 95% or greater overlap, pick highest confidence
-                    if len(full) > 1:
-                        eye = eyes[full]
-                        eye = eye[eye.scores.argmax().item()]
-                    else:
-                        max_ind = max(range(len(eye_ols)),
-                                      key=eye_ols.__getitem__)
-                        eye = eyes[max_ind]
-            else:
-                eye = None
+            eye = eyes[eye_indices[i]] if eye_indices[i] >= 0 else None
             bbox = [round(x) for x in curr_fish.pred_boxes.tensor.cpu().numpy().astype('float64')[0]]
-            detectron_mask = curr_fish.pred_masks[0].cpu().numpy()
+            window = mask_window(bbox, im_gray.shape)
+            detectron_mask = instance_mask(curr_fish, im_gray.shape, window)
             val = adaptive_threshold(bbox, im_gray)
-            bbox, mask, pixel_anal_failed = gen_mask_upscale(bbox, file_path,
-                                                             file_name, im_gray, val, detectron_mask)
-            centroid, evecs = pca(mask)[:2]
+            bbox, mask, offset, pixel_anal_failed = gen_mask_upscale(bbox, file_path, file_name, im_gray, val,
+                                                                     detectron_mask, window[:2])
+            features = FishFeatures(mask, offset)
+            centroid, evecs = features.centroid.astype(int), features.axes
             major, minor = evecs[0], evecs[1]
             results['fish'][i]['has_eye'] = bool(eye)
             if eye:
@@ -383,19 +666,23 @@ def gen_metadata_upscale(file_path, fish, device=None):
                 if dist2 > dist1:
                     major *= -1
                 results['fish'][i]['side'] = 'left' if major[0] <= 0.0 else 'right'
-                snout_vec = major
+                snout_vec = find_snout_vec(centroid, eye_center, mask, offset)
                 results['fish'][i]['clock_value'] = clock_value(major if snout_vec is None else snout_vec, file_name)
     return {f_name: results}
 
 
-def upscale(im, bbox, f_name, factor, device):
+def upscale(im, bbox, f_name, factor, predictor):
+    """
+    Looks for the eye of a fish in its bbox crop upscaled by factor, running the crop through predictor
+    in memory.
+    Returns:
+        eye_center, side, clock_val -- eye center in image coordinates, side and clock value, or Nones.
+    """
     h, w = bbox[3] - bbox[1], bbox[2] - bbox[0]
-    scaled = cv2.resize(im[bbox[1]:bbox[3], bbox[0]:bbox[2]].copy(), (w * factor, h * factor),
+    scaled = cv2.resize(im[bbox[1]:bbox[3], bbox[0]:bbox[2]], (w * factor, h * factor),
                         interpolation=cv2.INTER_CUBIC)
-    os.makedirs('images/testing', exist_ok=True)
-    cv2.imwrite(f'images/testing/{f_name}.png', scaled)
     eye_center, side, clock_val, scale = None, None, None, None
-    new_data = gen_metadata_upscale(f'images/testing/{f_name}.png', scaled, device=device)
+    new_data = gen_metadata_upscale(f_name, scaled, predictor)
     if 'fish' in new_data[f'{f_name}'] and new_data[f'{f_name}']['fish'][0]['has_eye']:
         eye_center = new_data[f'{f_name}']['fish'][0]['eye_center']
         eye_x, eye_y = eye_center
@@ -406,8 +693,6 @@ def upscale(im, bbox, f_name, factor, device):
         eye_center = [eye_x, eye_y]
         side = new_data[f'{f_name}']['fish'][0]['side']
         clock_val = new_data[f'{f_name}']['fish'][0]['clock_value']
-    if os.path.isfile(f'images/testing/{f_name}.png'):
-        os.remove(f'images/testing/{f_name}.png')
     return eye_center, side, clock_val
 
 
@@ -420,12 +705,48 @@ def adaptive_threshold(bbox, im_gray):
     Returns:
         val -- new threshold.
     """
-    im_crop = im_gray[bbox[1]:bbox[3], bbox[0]:bbox[2]]
-    val = filters.threshold_otsu(im_crop)
-    mask = np.where(im_crop > val, 1, 0).astype(np.uint8)
-    flat_mask = mask.reshape(-1)
-    bground = im_crop.reshape(-1)[np.where(np.logical_not(flat_mask))]
-    mean_b = np.mean(bground)
+    return histogram_threshold(crop_histogram(bbox, im_gray))
+
+
+def crop_histogram(bbox, im_gray):
+    """
+    Returns the 256-bin histogram of the bbox crop of the uint8 image im_gray.
+    """
+    return np.bincount(im_gray[bbox[1]:bbox[3], bbox[0]:bbox[2]].ravel(), minlength=256)
+
+
+def grow_histogram(hist, bbox, new_bbox, im_gray):
+    """
+    Adds to hist, the histogram of the bbox crop, the pixels of new_bbox (which contains bbox) outside bbox.
+    """
+    left, top, right, bottom = bbox
+    new_left, new_top, new_right, new_bottom = new_bbox
+    for strip in (im_gray[new_top:top, new_left:new_right], im_gray[bottom:new_bottom, new_left:new_right],
+                  im_gray[top:bottom, new_left:left], im_gray[top:bottom, right:new_right]):
+        hist += np.bincount(strip.ravel(), minlength=256)
+    return hist
+
+
+def histogram_threshold(hist):
+    """
+    Computes adaptive_threshold from the histogram of a crop: Otsu's threshold (as filters.threshold_otsu computes
+    it for a uint8 image), moved away from the mean of the pixels at or below it by VAL_SCALE_FAC of the distance.
+    """
+    values = np.flatnonzero(hist)
+    low, high = values[0], values[-1]
+    if low == high:
+        val = low
+    else:
+        counts = hist[low:high + 1].astype(np.float64)
+        bin_centers = np.arange(low, high + 1)
+        weight1 = np.cumsum(counts)
+        weight2 = np.cumsum(counts[::-1])[::-1]
+        mean1 = np.cumsum(counts * bin_centers) / weight1
+        mean2 = (np.cumsum((counts * bin_centers)[::-1]) / weight2[::-1])[::-1]
+        variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+        val = bin_centers[np.argmax(variance12)]
+    bground = hist[:val + 1]
+    mean_b = np.dot(bground, np.arange(val + 1)) / bground.sum()
     flipped = False
     diff = abs(mean_b - val)
     if flipped:
@@ -436,41 +757,36 @@ def adaptive_threshold(bbox, im_gray):
     return val
 
 
-def find_snout_vec(centroid, eye_center, mask):
+def find_snout_vec(centroid, eye_center, mask, offset=(0, 0)):
     """
     Determine the direction of the snout.
     Parameters:
         centroid -- center of fish in [x, y] format.
         eye_center -- center of eye in [x, y] format.
         mask -- thresholded image.
+        offset -- (x, y) position of mask in the full image.
     Returns:
         max_vec / max_len -- vector pointing in direction of snout.
     """
-    eye_dir = eye_center - centroid
-    x1 = centroid[0]
-    y1 = centroid[1]
-    max_len = 0
-    max_vec = None
-    for x in range(mask.shape[1]):
-        for y in range(mask.shape[0]):
-            if mask[y, x]:
-                x2 = x
-                y2 = y
-                curr_dir = np.array([x2 - x1, y2 - y1])
-                curr_eye_dir = np.array([x2 - eye_center[0],
-                                         y2 - eye_center[1]])
-                curr_len = np.linalg.norm(curr_dir)
-                if curr_len > max_len:
-                    fallback = curr_dir
-                    max_len = curr_len
-                    if curr_len > np.linalg.norm(curr_eye_dir):
-                        max_vec = curr_dir
+    # Fish pixels in [x, y] format, visited column by column
+    x, y = np.nonzero(mask.T)
+    if not len(x):
+        return None
+    coords = np.column_stack([x + offset[0], y + offset[1]])
+    curr_dir = coords - np.asarray(centroid)
+    curr_len = np.linalg.norm(curr_dir, axis=1)
+    curr_eye_len = np.linalg.norm(coords - np.asarray(eye_center), axis=1)
+    # The snout is the last pixel that was the farthest from the centroid so
+    # far when visited while being farther from the centroid than from the eye
+    prev_max = np.maximum.accumulate(np.concatenate([[0], curr_len[:-1]]))
+    snout = np.flatnonzero((curr_len > prev_max) & (curr_len > curr_eye_len))
+    max_len = curr_len.max()
     if max_len == 0:
         return None
-    if max_vec is None:
+    if not len(snout):
         print(f'Failed snout')
         return None
-    return max_vec / max_len
+    return curr_dir[snout[-1]] / max_len
 
 
 def angle(vec1, vec2):
@@ -513,75 +829,25 @@ def clock_value(evec, file_name):
     return round(clock)
 
 
-def fish_box_length(mask, centroid, evec, scale):
+def select_eyes(fish, eyes):
     """
-    Check how far fish pixels gets in each direction from the centroid of
-    the fish blob then return fish length. This is done by
-    intersection the major axis with a line defined by a given fish pixel
-    and the minor axis, then finding which two intersection points are
-    farthest from the centroid in each direction.
-    Parameters:
-        mask -- thresholded image.
-        centroid -- center of fish in [x, y] format.
-        evec -- major axis of fish.
-        scale -- pixels per unit.
-    Returns:
-        distance -- distance from max to min points on major axis.
-    """
-    m1 = evec[1] / evec[0]
-    m2 = evec[0] / evec[1]
-    # Set these as the first point for point slope form of a line
-    # to be used with m1
-    x1 = centroid[0]
-    y1 = centroid[1]
-    # Initial values for how far from the major axis
-    # points project in each direction
-    x_min = centroid[0]
-    x_max = centroid[0]
-    # Loop over every pixel in the bounding box
-    for x in range(mask.shape[1]):
-        for y in range(mask.shape[0]):
-            # If it is a fish pixel
-            if mask[y, x]:
-                # Set this as the second point for point slope form of a line
-                # to be sued with m2
-                x2 = x
-                y2 = y
-                # Intersect the major axis with the line formed by x2, y2 and
-                # m2. I calculated this using basic algebra given the two
-                # line equations.
-                x_calc = (-y1 + y2 + m1 * x1 - m2 * x2) / (m1 - m2)
-                y_calc = m1 * (x_calc - x1) + y1
-                # If this is the new furthest point in one or the other,
-                # save it
-                if x_calc > x_max:
-                    x_max = x_calc
-                    y_max = y_calc
-                elif x_calc < x_min:
-                    x_min = x_calc
-                    y_min = y_calc
-    # Return the distance between the points we've found scaled into cms
-    return distance((x_max, y_max), (x_min, y_min)) / scale
-
-
-def overlap(fish, eye):
-    """
-    Checks if the eye is in the fish.
+    Picks the eye of every fish from the fish x eye matrix of the percent of each eye that is inside
+    each fish. When several eyes are at least 95% inside a fish the highest confidence one is picked,
+    otherwise the eye overlapping it the most.
     Parameters:
-        fish -- fish coordinates.
-        eye -- eye coordinates.
+        fish -- fish Instances.
+        eyes -- eye Instances.
     Returns:
-        ol_pct -- percent of eye that is inside the fish.
+        eye_indices -- index in eyes of the eye of each fish, -1 when no eye overlaps it.
     """
-    fish = list(fish.pred_boxes.tensor.cpu().numpy()[0])
-    eye = list(eye.pred_boxes.tensor.cpu().numpy()[0])
-    if not (fish[0] < eye[2] and eye[0] < fish[2] and fish[1] < eye[3]
-            and eye[1] < eye[3]):
-        return 0
-    pairs = list(zip(fish, eye))
-    ol_area = (max(pairs[0]) - min(pairs[2])) * (max(pairs[1]) - min(pairs[3]))
-    ol_pct = ol_area / ((eye[0] - eye[2]) * (eye[1] - eye[3]))
-    return ol_pct
+    if not len(eyes):
+        return [-1] * len(fish)
+    ol_pct = pairwise_ioa(fish.pred_boxes, eyes.pred_boxes)
+    full = ol_pct >= .95
+    most_confident = torch.where(full, eyes.scores, eyes.scores.new_tensor(-1.)).argmax(dim=1)
+    eye_indices = torch.where(full.sum(dim=1) > 1, most_confident, ol_pct.argmax(dim=1))
+    eye_indices[(ol_pct == 0).all(dim=1)] = -1
+    return eye_indices.tolist()
 
 
 def overlap_eye(fish, eye):
@@ -593,22 +859,188 @@ def overlap_eye(fish, eye):
     return pairwise_ioa(fish, eye).item()
 
 
-def overlap_fish(fish1, fish2):
+def select_fish(fish, iou_threshold=IOU_PCT):
+    """
+    Greedy non-maximum suppression of overlapping fish from their fish x fish IoU matrix. Going
+    through the fish in order (detectron2 sorts them by descending score), each kept fish drops
+    the following ones whose box IoU with it is over iou_threshold.
+    Parameters:
+        fish -- fish Instances.
+        iou_threshold -- IoU over which two fish are considered the same.
+    Returns:
+        keep -- indices of the kept fish, in order.
+    """
+    overlaps = (pairwise_iou(fish.pred_boxes, fish.pred_boxes) > iou_threshold).cpu().numpy()
+    suppressed = np.zeros(len(fish), dtype=bool)
+    keep = []
+    for i in range(len(fish)):
+        if not suppressed[i]:
+            keep.append(i)
+            suppressed |= overlaps[i]
+    return keep
+
+
+class FishFeatures:
     """
-    Checks if the two fish overlap.
+    Shape features of one fish mask crop. Each feature is computed the first time it is used,
+    from intermediate results (moments, pixel coordinates, regionprops) shared with the others.
+    Parameters:
+        mask -- binary mask crop of the fish.
+        offset -- (x, y) position of mask in the full image.
     """
-    fish1 = Boxes(fish1.pred_boxes.tensor)
-    fish2 = Boxes(fish2.pred_boxes.tensor)
-    return pairwise_iou(fish1, fish2).item()
+
+    def __init__(self, mask, offset=(0, 0)):
+        self.mask = mask
+        self.offset = offset
+
+    @cached_property
+    def moments(self):
+        return cv2.moments(self.mask, binaryImage=True)
+
+    @cached_property
+    def coords(self):
+        """
+        x and y coordinates of the fish pixels in the crop.
+        """
+        y, x = np.nonzero(self.mask)
+        return x, y
+
+    @cached_property
+    def region(self):
+        return measure.regionprops(self.mask)[0]
+
+    @property
+    def area(self):
+        return len(self.coords[0])
+
+    @cached_property
+    def centroid(self):
+        """
+        Center of the fish in [x, y] format, in the full image.
+        """
+        m = self.moments
+        return np.array([m["m10"] / m["m00"] + self.offset[0], m["m01"] / m["m00"] + self.offset[1]])
+
+    @cached_property
+    def axes(self):
+        """
+        Eigenvectors of the covariance matrix of the fish pixels as columns, major axis first.
+        """
+        m = self.moments
+        # Same covariance matrix as np.cov of the fish pixel coordinates
+        cov = np.array([[m["mu20"], m["mu11"]],
+                        [m["mu11"], m["mu02"]]]) / (m["m00"] - 1)
+        evals, evecs = np.linalg.eig(cov)
+        return evecs[:, np.argsort(evals)[::-1]]
+
+    @cached_property
+    def inertia_eigvals(self):
+        """
+        Eigenvalues of the inertia tensor, largest first, as in skimage regionprops.
+        """
+        m = self.moments
+        a, b, c = m["mu20"] / m["m00"], -m["mu11"] / m["m00"], m["mu02"] / m["m00"]
+        root = math.sqrt(4 * b ** 2 + (a - c) ** 2)
+        return max(0, (a + c + root) / 2), max(0, (a + c - root) / 2)
+
+    @property
+    def eccentricity(self):
+        l1, l2 = self.inertia_eigvals
+        return math.sqrt(1 - l2 / l1) if l1 else 0
+
+    @property
+    def major_axis_length(self):
+        return 4 * math.sqrt(self.inertia_eigvals[0])
+
+    @property
+    def minor_axis_length(self):
+        return 4 * math.sqrt(self.inertia_eigvals[1])
+
+    @cached_property
+    def orientation(self):
+        """
+        Angle between the rows and the major axis, in radians, as in skimage regionprops.
+        """
+        m = self.moments
+        a, b, c = m["mu20"] / m["m00"], -m["mu11"] / m["m00"], m["mu02"] / m["m00"]
+        if a - c == 0:
+            return -math.pi / 4 if b < 0 else math.pi / 4
+        return 0.5 * math.atan2(-2 * b, c - a)
+
+    @cached_property
+    def projections(self):
+        """
+        Coordinates of the fish pixels along the major and minor axes, relative to the centroid.
+        """
+        x_v1, y_v1 = self.axes[:, 0]
+        # negate eigenvector
+        if x_v1 < 0:
+            x_v1 *= -1
+            y_v1 *= -1
+        m = self.moments
+        x, y = self.coords
+        x = x.astype(np.float32) - np.float32(m["m10"] / m["m00"])
+        y = y.astype(np.float32) - np.float32(m["m01"] / m["m00"])
+        return np.float32(x_v1) * x + np.float32(y_v1) * y, np.float32(x_v1) * y - np.float32(y_v1) * x
+
+    @cached_property
+    def dimensions(self):
+        """
+        Contour length and width, through the most populated row and column across the fish,
+        and overall length and width along the axes, in pixels.
+        """
+        x_round, y_round = (np.rint(p).astype(np.int32) for p in self.projections)
+        x_min, y_min = x_round.min(), y_round.min()
+        x_calc = np.bincount(x_round - x_min).argmax() + x_min
+        y_calc = np.bincount(y_round - y_min).argmax() + y_min
+        y_at_x, x_at_y = y_round[x_round == x_calc], x_round[y_round == y_calc]
+        return (float(x_at_y.max() - x_at_y.min()), float(y_at_x.max() - y_at_x.min()),
+                float(x_round.max() - x_min), float(y_round.max() - y_min))
+
+    @property
+    def extent(self):
+        x, y = self.coords
+        return self.area / ((x.max() - x.min() + 1) * (y.max() - y.min() + 1))
+
+    @property
+    def convex_area(self):
+        return self.region.convex_area
+
+    @property
+    def solidity(self):
+        return self.area / self.convex_area
+
+    @property
+    def feret_diameter_max(self):
+        return self.region.feret_diameter_max
+
+    @cached_property
+    def perimeter(self):
+        return measure.perimeter(self.mask, neighbourhood=8)
+
+    @cached_property
+    def skew(self):
+        return [stats.skew(c) for c in self.coords]
+
+    @cached_property
+    def kurtosis(self):
+        return [stats.kurtosis(c) for c in self.coords]
+
+    @cached_property
+    def std(self):
+        return [np.std(c) for c in self.coords]
 
 
 # https://alyssaq.github.io/2015/computing-the-axes-or-orientation-of-a-blob/
-def pca(img, glob_scale=None, visualize=False):
+def pca(img, glob_scale=None, visualize=False, offset=(0, 0)):
     """
     Performs principle component analysis on a grayscale image.
+    The axes come from the second order central moments of the mask, and
+    length and width from the projections of the fish pixels onto them.
     Parameters:
-        img -- grayscale image.
+        img -- grayscale image, or its FishFeatures.
         glob_scale -- pixels per unit.
+        offset -- (x, y) position of img in the full image, added to the centroid.
     Returns:
         np.array(centroid) -- numpy array containing centroid.
         evecs[:, sort_indices[0]] -- major axis, or eigenvector associated with highest eigenvalue.
@@ -616,57 +1048,27 @@ def pca(img, glob_scale=None, visualize=False):
         width -- width of fish.
         area -- area of fish.
     """
-    moments = cv2.moments(img)
-    centroid = (int(moments["m10"] / moments["m00"]),
-                int(moments["m01"] / moments["m00"]))
-    y, x = np.nonzero(img)
-
-    x = x - np.mean(x)
-    y = y - np.mean(y)
-    coords = np.vstack([x, y])
-
-    cov = np.cov(coords)
-    evals, evecs = np.linalg.eig(cov)
-    sort_indices = np.argsort(evals)[::-1]
-    # Eigenvector with largest eigenvalue
-    x_v1, y_v1 = evecs[:, sort_indices[0]]
-    # negate eigenvector
-    if x_v1 < 0:
-        x_v1 *= -1
-        y_v1 *= -1
-    theta = np.arctan2(y_v1, x_v1)
-    rotation_mat = np.matrix([[np.cos(theta), -np.sin(theta)],
-                              [np.sin(theta), np.cos(theta)]])
-    transformed_mat = rotation_mat * coords
-    x_transformed, y_transformed = transformed_mat.A
-    x_round, y_round = x_transformed.round(
-        decimals=0), y_transformed.round(decimals=0)
-    x_vals, x_counts = np.unique(x_round, return_counts=True)
-    y_vals, y_counts = np.unique(y_round, return_counts=True)
-    x_calc, y_calc = x_vals[x_counts.argmax()], y_vals[y_counts.argmax()]
-    x_indices, y_indices = np.where(
-        x_round == x_calc), np.where(y_round == y_calc)
-    cont_width = y_round[x_indices].max() - y_round[x_indices].min()
-    cont_length = x_round[y_indices].max() - x_round[y_indices].min()
-    width = y_vals.max() - y_vals.min()
-    length = x_vals.max() - x_vals.min()
+    features = img if isinstance(img, FishFeatures) else FishFeatures(img, offset)
+    centroid = features.centroid.astype(int)
+    cont_length, cont_width, length, width = features.dimensions
 
     if visualize:
-        x_v2, y_v2 = evecs[:, sort_indices[1]]
+        x_v1, y_v1 = features.axes[:, 0]
+        x_v2, y_v2 = features.axes[:, 1]
+        x, y = features.coords
+        x_transformed, y_transformed = features.projections
         scale = 300
         plt.plot([x_v1 * -scale * 2, x_v1 * scale * 2],
                  [y_v1 * -scale * 2, y_v1 * scale * 2], color='red')
         plt.plot([x_v2 * -scale, x_v2 * scale],
                  [y_v2 * -scale, y_v2 * scale], color='blue')
-        plt.plot(x, y, 'y.')
+        plt.plot(x - x.mean(), y - y.mean(), 'y.')
         plt.axis('equal')
         plt.gca().invert_yaxis()  # Match the image system with origin at top left
-        plt.axhline(y=y_calc)
-        plt.axvline(x=x_calc)
         plt.plot(x_transformed, y_transformed, 'g.')
         plt.show()
 
-    area = transformed_mat.shape[1]
+    area = features.area
     if glob_scale is not None:
         cont_length /= glob_scale
         cont_width /= glob_scale
@@ -674,7 +1076,7 @@ def pca(img, glob_scale=None, visualize=False):
         width /= glob_scale
         area /= glob_scale ** 2
 
-    return np.array(centroid), evecs[:, sort_indices], cont_length, cont_width, length, width, area
+    return centroid, features.axes, cont_length, cont_width, length, width, area
 
 
 def find_nearest(array, value):
@@ -685,26 +1087,6 @@ def find_nearest(array, value):
     return array[idx]
 
 
-def encode_freeman(image_contour):
-    """
-    Encode the image contour in an 8-direction freeman chain code based on angles
-    """
-    freeman_code = ""
-    freeman_dict = {-90: '0', -45: '1', 0: '2',
-                    45: '3', 90: '4', 135: '5', 180: '6', -135: '7'}
-    allowed_directions = np.array([0, 45, 90, 135, 180, -45, -90, -135])
-
-    for i in range(len(image_contour) - 1):
-        delta_x = image_contour[i + 1][1] - image_contour[i][1]
-        delta_y = image_contour[i + 1][0] - image_contour[i][0]
-        angle = allowed_directions[np.abs(
-            allowed_directions - np.rad2deg(np.arctan2(delta_y, delta_x))).argmin()]
-        if not (delta_x == 0 and delta_y == 0):
-            freeman_code += freeman_dict[angle]
-
-    return freeman_code
-
-
 def create_svg(contour, shape):
     with open('image.svg', 'w+') as f:
         f.write(
@@ -717,10 +1099,15 @@ def create_svg(contour, shape):
         f.write('</svg>')
 
 
-def encoded_mask(mask, visualize=False):
-    # Extract the longest contour in the image
-    contours = measure.find_contours(mask, 0.9)
-    contours_main = np.around(max(contours, key=len), decimals=0)
+def encoded_mask(mask, visualize=False, offset=(0, 0), shape=None):
+    # Extract the longest contour in the image. The crop is padded with the background around it, except on
+    # the sides at the edge of the image (of the given shape), so the contour is the one of the full mask
+    height, width = mask.shape[:2]
+    pad_top, pad_left = int(offset[1] > 0), int(offset[0] > 0)
+    pad_bottom = int(shape is None or offset[1] + height < shape[0])
+    pad_right = int(shape is None or offset[0] + width < shape[1])
+    contours = measure.find_contours(np.pad(mask, ((pad_top, pad_bottom), (pad_left, pad_right))), 0.9)
+    contours_main = np.around(max(contours, key=len), decimals=0) + [offset[1] - pad_top, offset[0] - pad_left]
 
     if visualize:
         # Display the image and plot the main contour found
@@ -733,18 +1120,31 @@ def encoded_mask(mask, visualize=False):
     return contours_main[0][::-1], encode_freeman(contours_main)
 
 
+def mask_record(mask, offset, shape, mask_format='freeman'):
+    """
+    Encodes a fish mask crop for the metadata JSON.
+    Parameters:
+        mask -- binary mask crop of the fish.
+        offset -- (x, y) position of mask in the full image.
+        shape -- shape of the full image.
+        mask_format -- one of MASK_FORMATS other than none (see mask_codecs).
+    Returns:
+        record -- dictionary stored as the mask of the fish.
+    """
+    if mask_format == 'rle':
+        return encode_rle(mask, offset, shape)
+    start, code = encoded_mask(mask, offset=offset, shape=shape)
+    if mask_format == 'freeman-packed':
+        return {'start_coord': list(start), 'encoding': pack_freeman(code), 'length': len(code)}
+    return {'start_coord': list(start), 'encoding': code}
+
+
 def decode_freeman(contour, mask, code, visualize=False):
-    coords = [list(contour[0][::-1])]
-    freeman_dict = {0: [0, -1], 1: [1, -1], 2: [1, 0],
-                    3: [1, 1], 4: [0, 1], 5: [-1, 1], 6: [-1, 0], 7: [-1, -1]}
-    for letter in code:
-        change = freeman_dict[int(letter)]
-        current = coords[-1]
-        coords.append([current[0] + change[0], current[1] + change[1]])
+    coords = freeman_contour(contour[0][::-1], np.frombuffer(code.encode('ascii'), dtype=np.uint8) - ord('0'))
     # create_svg(coords, mask.shape)
     # np.savetxt('foo.csv', coords, delimiter=",", fmt='%f')
     if visualize:
-        cnt = np.array(coords)
+        cnt = coords
         fig, ax = plt.subplots()
         ax.imshow(mask, cmap=plt.cm.gray)
         ax.plot(cnt[:, 0], cnt[:, 1])
@@ -798,9 +1198,49 @@ def check(arr, val, flipped):
     return arr < val
 
 
-def gen_mask(bbox, file_path, file_name, im_gray, val, detectron_mask, flipped=False):
+def fish_component(thresh, min_fraction=.1):
+    """
+    Selects the fish in a thresholded crop: the largest 8-connected region of below threshold pixels, with its
+    holes filled.
+    Parameters:
+        thresh -- binary crop, 1 where the pixel is below the threshold.
+        min_fraction -- fraction of the crop the region has to cover.
+    Returns:
+        mask -- binary uint8 mask of the fish, or None when no region covers more than min_fraction of the crop.
+    """
+    labels = measure.label(thresh, connectivity=2)
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    fish = sizes.argmax()
+    if sizes[fish] / thresh.size <= min_fraction:
+        return None
+    return fill_holes(labels == fish).astype(np.uint8)
+
+
+def fill_holes(mask):
+    """
+    Fills the holes of a binary mask: the 8-connected background regions that do not touch its border.
+    Same result as a morphological reconstruction by erosion seeded from the border, in one labeling pass.
+    """
+    background = measure.label(mask == 0, connectivity=2)
+    border = np.concatenate([background[0], background[-1], background[:, 0], background[:, -1]])
+    return np.logical_not(np.isin(background, border[border > 0]))
+
+
+def gen_mask(bbox, file_path, file_name, im_gray, val, detectron_mask, flipped=False, detectron_offset=(0, 0)):
     """
     Generates the mask for the fish and floodfills to make a whole image.
+    When the fish touches a side of the bbox, that side is pushed out by BBOX_GROW_STEP of the bbox size, with
+    the step doubling on every pass it still touches. The grown sides are then pulled back to one pixel
+    outside the fish, and the threshold and mask are computed again on that final box (growing it again
+    if the fish now touches it), as the one-pixel search did.
+    Parameters:
+        detectron_mask -- crop of the detectron mask whose top left corner is at detectron_offset, used as fallback.
+    Returns:
+        bbox -- bbox of the fish.
+        mask -- crop of the mask covering bbox.
+        offset -- (x, y) position of the mask crop in im_gray.
+        failed -- whether pixel analysis failed and the detectron mask and bbox are returned.
     """
     failed = False
     left = round(bbox[0])
@@ -810,72 +1250,65 @@ def gen_mask(bbox, file_path, file_name, im_gray, val, detectron_mask, flipped=F
     bbox_orig = bbox
     bbox = (left, top, right, bottom)
 
-    im = im_gray.copy()
-    shape = im.shape
-    done = False
-    im_crop = im[top:bottom, left:right]
-    fish_pix, thresh, new_mask = None, None, None
-
-    while not done:
-        done = True
-        im_crop = im[top:bottom, left:right]
-        count = 0
+    shape = im_gray.shape
+    # steps and growth of the left, top, right and bottom sides
+    step_x = max(1, round((right - left) * BBOX_GROW_STEP))
+    step_y = max(1, round((bottom - top) * BBOX_GROW_STEP))
+    steps = [step_x, step_y, step_x, step_y]
+    grown = [False] * 4
+    # histogram of the crop, built when the bbox first grows
+    hist = None
+    # final boxes already thresholded, against a grow / pull back cycle
+    pulled_back = set()
+
+    while True:
+        im_crop = im_gray[top:bottom, left:right]
         thresh = np.where(im_crop < val, 1, 0).astype(np.uint8)
-        indices = list(zip(*np.where(thresh == 1)))
-        shuffle(indices)
-        for ind in indices:
-            if fish_pix is not None:
-                ind = fish_pix
-            count += 1
-            # if 10k pass and fish not found
-            if count > 10000:
-                if fish_pix is not None:
-                    fish_pix = None
-                else:
-                    print(f'ERROR on flood fill: {file_name}')
-                    return bbox_orig, detectron_mask.astype('uint8'), True
-            temp = flood_fill(thresh, ind, 2)
-            temp = np.where(temp == 2, 1, 0)
-            percent = np.count_nonzero(temp) / im_crop.size
-            if percent > 0.1:
-                fish_pix = ind
-                for i in (0, temp.shape[0] - 1):
-                    for j in (0, temp.shape[1] - 1):
-                        temp = flood_fill(temp, (i, j), 2)
-                thresh = np.where(temp != 2, 1, 0).astype(np.uint8)
+        if np.any(thresh):
+            thresh = fish_component(thresh)
+            if thresh is None:
+                print(f'ERROR on flood fill: {file_name}')
+                return bbox_orig, detectron_mask.astype('uint8'), detectron_offset, True
+        touching = [left > 0 and np.any(thresh[:, 0]), top > 0 and np.any(thresh[0]),
+                    right < shape[1] and np.any(thresh[:, -1]), bottom < shape[0] and np.any(thresh[-1])]
+        if not any(touching):
+            if not any(grown) or not np.any(thresh):
                 break
-        new_mask = np.full(shape, 0).astype(np.uint8)
-        new_mask[top:bottom, left:right] = thresh
+            final_bbox = tight_bbox(thresh, (left, top, right, bottom), grown, shape)
+            if final_bbox == (left, top, right, bottom) or final_bbox in pulled_back:
+                break
+            # The threshold came from the overshooting box: compute it and the mask again on the final box
+            pulled_back.add(final_bbox)
+            left, top, right, bottom = final_bbox
+            hist = crop_histogram(final_bbox, im_gray)
+            val = histogram_threshold(hist)
+            steps = [step_x, step_y, step_x, step_y]
+            continue
+        crop_bbox = (left, top, right, bottom)
+        if hist is None:
+            hist = crop_histogram(crop_bbox, im_gray)
         # Expands the bounding box
-        try:
-            if np.any(new_mask[top:bottom, left] != 0) and left > 0:
-                left -= 1
-                left = max(0, left)
-                done = False
-            if np.any(new_mask[top:bottom, right] != 0) and right < shape[1] - 1:
-                right += 1
-                right = min(shape[1] - 1, right)
-                done = False
-            if np.any(new_mask[top, left:right] != 0) and top > 0:
-                top -= 1
-                top = max(0, top)
-                done = False
-            if np.any(new_mask[bottom, left:right] != 0) and bottom < shape[0] - 1:
-                bottom += 1
-                bottom = min(shape[0] - 1, bottom)
-                done = False
-        except:
-            print(f'{file_name}: Error expanding bounding box')
-            # done = True
-            return bbox_orig, detectron_mask.astype('uint8'), True
-        # New bbox
-        bbox = (left, top, right, bottom)
-        # New threshold
-        val = adaptive_threshold(bbox, im_gray)
-    if np.count_nonzero(thresh) / im_crop.size < .1:
+        left = max(0, left - steps[0]) if touching[0] else left
+        top = max(0, top - steps[1]) if touching[1] else top
+        right = min(shape[1], right + steps[2]) if touching[2] else right
+        bottom = min(shape[0], bottom + steps[3]) if touching[3] else bottom
+        steps = [step * 2 if touch else step for step, touch in zip(steps, touching)]
+        grown = [grow or touch for grow, touch in zip(grown, touching)]
+        # New threshold, from the histogram updated with the pixels the sides grew over
+        hist = grow_histogram(hist, crop_bbox, (left, top, right, bottom), im_gray)
+        val = histogram_threshold(hist)
+    new_mask = thresh
+    if any(grown) and np.any(thresh):
+        crop_left, crop_top = left, top
+        left, top, right, bottom = tight_bbox(thresh, (left, top, right, bottom), grown, shape)
+        new_mask = thresh[top - crop_top:bottom - crop_top, left - crop_left:right - crop_left]
+    bbox = (left, top, right, bottom)
+    offset = (left, top)
+    if np.count_nonzero(new_mask) / new_mask.size < .1:
         print(f'{file_name}: Using detectron mask and bbox')
         new_mask = detectron_mask.astype('uint8')
         bbox = bbox_orig
+        offset = detectron_offset
         failed = True
     # arr4 = np.where(new_mask == 1, 255, 0).astype(np.uint8)
     # (left, top, right, bottom) = shrink_bbox(new_mask)
@@ -888,10 +1321,57 @@ def gen_mask(bbox, file_path, file_name, im_gray, val, detectron_mask, flipped=F
     # dirname += 'enhanced/' if ENHANCE else 'non_enhanced/'
     # f_name = file_name.split('.')[0]
     # im2.save(f'{dirname}/gen_mask_{f_name}.png')
-    return bbox, new_mask, failed
+    return bbox, new_mask, offset, failed
+
+
+def tight_bbox(thresh, bbox, grown, shape):
+    """
+    Pulls the grown sides of bbox back to one pixel outside the fish of its thresh crop, within an image of
+    the given shape.
+    Parameters:
+        thresh -- mask crop of the fish covering bbox, not empty.
+        bbox -- (left, top, right, bottom) box of the crop.
+        grown -- whether each of the left, top, right and bottom sides grew.
+    Returns:
+        bbox -- the pulled back (left, top, right, bottom) box.
+    """
+    left, top, right, bottom = bbox
+    rows = np.flatnonzero(thresh.any(axis=1))
+    cols = np.flatnonzero(thresh.any(axis=0))
+    return (max(0, left + int(cols[0]) - 1) if grown[0] else left,
+            max(0, top + int(rows[0]) - 1) if grown[1] else top,
+            min(shape[1], left + int(cols[-1]) + 2) if grown[2] else right,
+            min(shape[0], top + int(rows[-1]) + 2) if grown[3] else bottom)
+
+
+def padded_crop(bbox, shape, pad=CROP_PAD):
+    """
+    Returns the (left, top, right, bottom) window around bbox padded by pad times its size on each side,
+    clipped to an image of the given shape.
+    """
+    pad_x = round((bbox[2] - bbox[0]) * pad)
+    pad_y = round((bbox[3] - bbox[1]) * pad)
+    return (max(0, bbox[0] - pad_x), max(0, bbox[1] - pad_y),
+            min(shape[1], bbox[2] + pad_x), min(shape[0], bbox[3] + pad_y))
 
 
-def gen_mask_upscale(bbox, file_path, file_name, im_gray, val, detectron_mask):
+def gen_mask_cropped(bbox, file_path, file_name, im_gray, detectron_mask, detectron_offset=(0, 0), pad=CROP_PAD):
+    """
+    Runs adaptive_threshold and gen_mask on a padded crop around bbox instead of the whole image,
+    then maps the resulting bbox and mask offset back to image coordinates.
+    """
+    left, top, right, bottom = padded_crop(bbox, im_gray.shape, pad)
+    crop_bbox = [bbox[0] - left, bbox[1] - top, bbox[2] - left, bbox[3] - top]
+    crop_gray = im_gray[top:bottom, left:right]
+    val = adaptive_threshold(crop_bbox, crop_gray)
+    crop_bbox, mask, offset, failed = gen_mask(crop_bbox, file_path, file_name, crop_gray, val, detectron_mask,
+                                               detectron_offset=(detectron_offset[0] - left,
+                                                                 detectron_offset[1] - top))
+    bbox = [crop_bbox[0] + left, crop_bbox[1] + top, crop_bbox[2] + left, crop_bbox[3] + top]
+    return bbox, mask, (offset[0] + left, offset[1] + top), failed
+
+
+def gen_mask_upscale(bbox, file_path, file_name, im_gray, val, detectron_mask, detectron_offset=(0, 0)):
     failed = False
     l = round(bbox[0])
     r = round(bbox[2])
@@ -899,18 +1379,17 @@ def gen_mask_upscale(bbox, file_path, file_name, im_gray, val, detectron_mask):
     b = round(bbox[3])
     bbox_orig = bbox
     bbox = (l, t, r, b)
+    offset = (l, t)
 
-    im = im_gray.copy()
-    im_crop = im[t:b, l:r]
-    thresh = np.where(im_crop < val, 1, 0).astype(np.uint8)
-    new_mask = np.full(im.shape, 0).astype(np.uint8)
-    new_mask[t:b, l:r] = thresh
-    if np.count_nonzero(thresh) / im_crop.size < .1:
+    im_crop = im_gray[t:b, l:r]
+    new_mask = np.where(im_crop < val, 1, 0).astype(np.uint8)
+    if np.count_nonzero(new_mask) / im_crop.size < .1:
         print(f'{file_name}: Using detectron mask and bbox')
         new_mask = detectron_mask.astype('uint8')
         bbox = bbox_orig
+        offset = detectron_offset
         failed = True
-    return bbox, new_mask, failed
+    return bbox, new_mask, offset, failed
 
 
 # https://stackoverflow.com/questions/31400769/bounding-box-of-numpy-array
@@ -926,17 +1405,33 @@ def shrink_bbox(mask):
     return cmin, rmin, cmax, rmax
 
 
-def gen_metadata_safe(file_path, device=None, maskfname=None, visfname=None):
+def gen_metadata_safe(file_path, device=None, maskfname=None, visfname=None, backend='detectron2', quantize=None,
+                      detect_size=None, decode_size=None, features=None, mask_format='freeman', multiple_fish=False,
+                      fish_workers=None):
     """
     Deals with erroneous metadata generation errors.
     """
     try:
-        return gen_metadata(file_path, device=device, maskfname=maskfname, visfname=visfname)
+        return gen_metadata(file_path, device=device, maskfname=maskfname, visfname=visfname, backend=backend,
+                            quantize=quantize, detect_size=detect_size, decode_size=decode_size,
+                            features=features, mask_format=mask_format, multiple_fish=multiple_fish,
+                            fish_workers=fish_workers)
     except Exception as e:
         print(f'{file_path}: Errored out ({e})')
         return {file_path: {'errored': True}}
 
 
+def feature_groups(value):
+    """
+    Parses the comma separated FEATURE_GROUPS names of --features.
+    """
+    groups = [] if value == 'none' else value.split(',')
+    unknown = [group for group in groups if group not in FEATURE_GROUPS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown feature groups: {", ".join(unknown)}')
+    return groups
+
+
 def argument_parser():
     parser = argparse.ArgumentParser(description='Generate metadata for one or more fish images.')
     parser.add_argument('file_or_directory',
@@ -948,12 +1443,39 @@ def argument_parser():
                         help='Output filename to which to print JSON metadata (instead of terminal).')
     parser.add_argument('--device', choices=['cpu', 'cuda'], default=None,
                         help='Override the default device used for the ML model.')
+    parser.add_argument('--backend', choices=BACKENDS, default='detectron2',
+                        help='Inference backend. Exported backends load the artifact written by export_model.py '
+                             'next to model_final.pth.')
+    parser.add_argument('--quantize', choices=QUANTIZE_MODES, default=None,
+                        help='Run a post-training quantized version of the model on the CPU. '
+                             'See check_quantization.py for its accuracy against the float model.')
+    parser.add_argument('--detect-size', type=int, default=None,
+                        help='Run detection on a copy of the image downscaled to this longest side, then run '
+                             'the pixel analysis on full resolution crops around each fish.')
+    parser.add_argument('--decode-size', type=int, default=None,
+                        help='Decode JPEGs at the largest 1/2, 1/4 or 1/8 reduction keeping the longest side at '
+                             'least this size. Every pixel measurement is then in the reduced resolution.')
+    parser.add_argument('--features', type=feature_groups, default=None,
+                        help='Comma separated groups of per fish properties to compute, out of '
+                             f'{",".join(FEATURE_GROUPS)}, or none. All of them by default.')
+    parser.add_argument('--mask-format', choices=MASK_FORMATS, default='freeman',
+                        help='Encoding of the fish masks in the JSON metadata: Freeman chain code as digits, '
+                             'Freeman chain code packed in 3 bits per step (base64), COCO RLE, or no mask.')
+    parser.add_argument('--multiple-fish', action='store_true',
+                        help='Keep every fish scoring over 0.3 that does not overlap a higher scoring fish, '
+                             'instead of only the best one.')
+    parser.add_argument('--fish-workers', type=int, default=None,
+                        help='Number of threads running the pixel analysis of the fish of an image with '
+                             '--multiple-fish. One per core by default. See check_fish_workers.py.')
     parser.add_argument('--maskfname',
                         help='Save a mask image with the provided filename. '
                              'Only supported when processing a single image file.')
     parser.add_argument('--visfname',
                         help='Overwrites default visualization filename. '
                              'Only supported when processing a single image file.')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Number of images passed to the model in a single forward pass '
+                             'when processing a directory.')
     return parser
 
 
@@ -973,7 +1495,11 @@ def main():
     num_files = len(files)
     if num_files == 1:
         results = [gen_metadata_safe(files[0], maskfname=args.maskfname,
-                                     visfname=args.visfname, device=args.device)]
+                                     visfname=args.visfname, device=args.device, backend=args.backend,
+                                     quantize=args.quantize, detect_size=args.detect_size,
+                                     decode_size=args.decode_size, features=args.features,
+                                     mask_format=args.mask_format, multiple_fish=args.multiple_fish,
+                                     fish_workers=args.fish_workers)]
     else:
         if args.maskfname:
             print("Error: The `--maskfname` argument cannot be used with multiple input files.")
@@ -981,7 +1507,18 @@ def main():
         if args.visfname:
             print("error: the `--visfname` argument cannot be used with multiple input files.")
             sys.exit(0)
-        results = map(gen_metadata_safe, files, [args.device] * num_files)
+        if args.batch_size > 1:
+            results = gen_metadata_batch(files, batch_size=args.batch_size, device=args.device,
+                                         backend=args.backend, quantize=args.quantize,
+                                         detect_size=args.detect_size, decode_size=args.decode_size,
+                                         features=args.features, mask_format=args.mask_format,
+                                         multiple_fish=args.multiple_fish, fish_workers=args.fish_workers)
+        else:
+            results = map(gen_metadata_safe, files, [args.device] * num_files, [None] * num_files,
+                          [None] * num_files, [args.backend] * num_files, [args.quantize] * num_files,
+                          [args.detect_size] * num_files, [args.decode_size] * num_files,
+                          [args.features] * num_files, [args.mask_format] * num_files,
+                          [args.multiple_fish] * num_files, [args.fish_workers] * num_files)
     output = {}
     for i in results:
         output[list(i.keys())[0]] = list(i.values())[0]
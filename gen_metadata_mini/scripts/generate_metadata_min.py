@@ -20,6 +20,7 @@ import json
 import math
 import os
 import sys
+from functools import lru_cache
 import torch
 import cv2
 import numpy as np
@@ -29,7 +30,7 @@ from detectron2.data import Metadata
 from detectron2.engine import DefaultPredictor
 from detectron2 import model_zoo
 from detectron2.utils.visualizer import Visualizer, ColorMode
-from detectron2.structures import Boxes, pairwise_ioa
+from detectron2.structures import Boxes, Instances, pairwise_ioa
 #from matplotlib import pyplot as plt # for development phase
 
 import warnings
@@ -42,6 +43,7 @@ except:
 
 sys.path.append(root_file_path)
 import utility as ut
+from model_backends import load_exported_predictor, paste_masks, predict_lazy
 
 # import configuration
 conf = json.load(open(os.path.join(root_file_path,'config/config.json'), 'r'))
@@ -49,11 +51,24 @@ PROCESSOR = conf['PROCESSOR']
 MODEL_WEIGHT = os.path.join(root_file_path, conf['MODEL_WEIGHT'])
 NUM_CLASSES = conf['NUM_CLASSES']
 VAL_SCALE_FAC = conf['VAL_SCALE_FAC']
-
-
-def init_model(processor=PROCESSOR, model_weight=MODEL_WEIGHT, NUM_CLASSES=5):
+# 'detectron2' or an exported backend from model_backends (e.g. 'torchscript'), DM_BACKEND overrides the config
+BACKEND = os.environ.get('DM_BACKEND', conf.get('BACKEND', 'detectron2'))
+# Longest side of the image used for detection (0: full resolution). When set, the pixel analysis runs
+# on a padded full resolution crop around the fish.
+DETECT_SIZE = conf.get('DETECT_SIZE', 0)
+# Minimum longest side of a JPEG decoded at reduced resolution (0: full resolution decode). When set, the
+# whole analysis runs on the reduced image.
+DECODE_SIZE = conf.get('DECODE_SIZE', 0)
+# Number of distinct predictors (processor/weights/classes combinations) kept loaded at once
+PREDICTOR_CACHE_SIZE = int(os.environ.get('DM_PREDICTOR_CACHE_SIZE', 4))
+
+
+@lru_cache(maxsize=PREDICTOR_CACHE_SIZE)
+def init_model(processor=PROCESSOR, model_weight=MODEL_WEIGHT, NUM_CLASSES=5, backend=BACKEND):
     '''
     Initialize model using config files for RCNN, the trained weights, and other parameters.
+    The predictor is cached (LRU) per argument combination, so repeated calls in the same
+    process reuse the loaded weights instead of rebuilding the model.
 
     Parameters
     ----------
@@ -63,13 +78,18 @@ def init_model(processor=PROCESSOR, model_weight=MODEL_WEIGHT, NUM_CLASSES=5):
         Location of the model weight .pth. The default is MODEL_WEIGHT.
     NUM_CLASSES : int, optional
         Number of classes detected by the segmentation model. The default is 5.
+    backend : string, optional
+        'detectron2' to build the model from model_weight, or an exported backend
+        ('torchscript') to load the artifact exported next to it. The default is BACKEND.
 
     Returns
     -------
     predictor : detectron2.engine.defaults.DefaultPredictor
-        Default predcitor use to detect object.
+        Default predcitor use to detect object (or the equivalent exported predictor).
 
     '''
+    if backend != 'detectron2':
+        return load_exported_predictor(model_weight, backend, processor)
     #root_file_path = os.path.dirname(__file__)
     cfg = get_cfg()
     #cfg.merge_from_file(os.path.join(root_file_path,'config/mask_rcnn_R_50_FPN_3x.yaml'))
@@ -104,7 +124,7 @@ def create_metadata_obj():
     return metadata
 
 
-def predict_detectron(file_path):
+def predict_detectron(file_path, detect_size=DETECT_SIZE):
     '''
     import the image file, enhance imae contrast and predict the classes
     Classes : ['fish', 'ruler', 'eye', 'two', 'three']
@@ -113,25 +133,103 @@ def predict_detectron(file_path):
     ----------
     file_path : string
         Loacation of the file (absolute path).
+    detect_size : int, optional
+        When set, detection runs on a copy downscaled to this longest side and the boxes are
+        mapped back to full resolution. The default is DETECT_SIZE.
 
     Returns
     -------
     insts : dectetron object detectron2.structures.instances.Instances
-        List of dict of list...
-    im : np.ndarray (dtype=uint8)
-        Image loaded by cv2.
+        List of dict of list... The masks are kept at ROI resolution (N, 1, 28, 28), see instance_mask.
+    image : ut.ImageContext
+        Image loaded by cv2, with its CLAHE enhanced versions computed once for the whole analysis.
     '''
 
-    # Initialize the model
+    # Initialize the model (cached after the first call)
     predictor = init_model()
-    # load the image
-    im = cv2.imread(file_path)
+    # load the image (decoded once, at reduced resolution when DECODE_SIZE is set)
+    image = ut.ImageContext(ut.load_image(file_path, DECODE_SIZE))
     # CLAHE + prediction
-    im_enh, im_gray = ut.enhance_contrast(im)
-    output = predictor(im_enh)
-    insts = output['instances']
+    output = predict_lazy(predictor, [downscale(image.enhanced, detect_size)], upsample=not detect_size)[0]
+    insts = rescale_instances(output, image.bgr.shape[:2])
+
+    return insts, image
+
+
+def downscale(im, detect_size):
+    '''
+    Downscale an image so its longest side is at most detect_size.
+
+    Parameters
+    ----------
+    im : np.ndarray (dtype=uint8)
+        Image to downscale.
+    detect_size : int
+        Maximum longest side, 0 or None to keep the full resolution.
+
+    Returns
+    -------
+    im : np.ndarray (dtype=uint8)
+        Downscaled image (im itself when it already fits).
+
+    '''
+    if not detect_size or max(im.shape[:2]) <= detect_size:
+        return im
+    factor = detect_size / max(im.shape[:2])
+    return cv2.resize(im, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+
+def rescale_instances(insts, shape):
+    '''
+    Map the predicted boxes to an image of the given shape. The masks are kept as predicted
+    (ROI or image resolution), see instance_mask.
+
+    Parameters
+    ----------
+    insts : detectron2.structures.instances.Instances
+        Predictions on the (possibly downscaled) image.
+    shape : tuple (int)
+        (height, width) of the full resolution image.
+
+    Returns
+    -------
+    insts : detectron2.structures.instances.Instances
+        Predictions with boxes in full resolution coordinates.
+
+    '''
+    if tuple(insts.image_size) == tuple(shape):
+        return insts
+    scaled = Instances(tuple(shape), **insts.get_fields())
+    scaled.pred_boxes = insts.pred_boxes.clone()
+    scaled.pred_boxes.scale(shape[1] / insts.image_size[1], shape[0] / insts.image_size[0])
+    scaled.pred_boxes.clip(tuple(shape))
+    return scaled
+
+
+def instance_mask(inst, shape):
+    '''
+    Mask of a single instance at the given image shape. ROI resolution masks are pasted here,
+    so only the instances that are used get a full size mask.
+
+    Parameters
+    ----------
+    inst : detectron2.structures.instances.Instances
+        Single instance.
+    shape : tuple (int)
+        Shape of the full resolution image.
 
-    return insts, im
+    Returns
+    -------
+    mask : np.ndarray (dtype=bool)
+        Mask of the instance.
+
+    '''
+    if inst.pred_masks.dim() == 4:
+        return paste_masks(inst, shape)[0].cpu().numpy()
+    mask = inst.pred_masks[0].cpu().numpy()
+    if mask.shape != tuple(shape[:2]):
+        mask = cv2.resize(mask.astype(np.uint8), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST) > 0
+    return mask
 
 
 def create_prediction_image(im, insts):
@@ -154,7 +252,22 @@ def create_prediction_image(im, insts):
     '''
     
     metadata = create_metadata_obj()
-    v = Visualizer(im[:, :, ::-1], metadata=metadata,scale=0.5,
+    if insts.pred_masks.dim() == 4:
+        # ROI resolution masks, paste them all at the half resolution of the drawing
+        # (only the main fish ever gets a full resolution mask)
+        im = cv2.resize(im, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+        insts = rescale_instances(insts, im.shape[:2])
+        insts = Instances(insts.image_size, **insts.get_fields())
+        insts.pred_masks = paste_masks(insts, im.shape)
+        scale = 1.0
+    else:
+        if len(insts) and tuple(insts.pred_masks.shape[1:]) != im.shape[:2]:
+            # detection ran on a downscaled image, draw at the resolution of the masks
+            height, width = insts.pred_masks.shape[1:]
+            im = cv2.resize(im, (width, height), interpolation=cv2.INTER_AREA)
+            insts = rescale_instances(insts, (height, width))
+        scale = 0.5
+    v = Visualizer(im[:, :, ::-1], metadata=metadata,scale=scale,
                    instance_mode=ColorMode.IMAGE_BW)
     vis = v.draw_instance_predictions(insts.to('cpu'))
     pred_image = vis.get_image()[:, :, ::-1]
@@ -162,14 +275,33 @@ def create_prediction_image(im, insts):
     return pred_image
 
 
-def get_ruler_metadata(insts, file_name):
+def class_index(insts):
+    '''
+    Split the predictions by class, once per image.
+
+    Parameters
+    ----------
+    insts : detectron2.structures.instances.Instances
+        All the predictions on the image.
+
+    Returns
+    -------
+    by_class : list
+        Instances of each class, indexed by class id (fish, ruler, eye, two, three).
+
+    '''
+    classes = insts.pred_classes
+    return [insts[classes == k] for k in range(NUM_CLASSES)]
+
+
+def get_ruler_metadata(by_class, file_name):
     '''
     Collect metatda related to the ruler
 
     Parameters
     ----------
-    insts : detectron instances object
-        Contained instances of object detected in each classes..
+    by_class : list of detectron instances object
+        Instances of object detected in each classes, from class_index.
     file_name : str
         name of the file, this use to know scale unit depending of file origin.
     Returns
@@ -182,19 +314,19 @@ def get_ruler_metadata(insts, file_name):
 
     # find the ruler
     try:
-        ruler = insts[insts.pred_classes == 1][0]
+        ruler = by_class[1][0]
         ruler_bbox = list(ruler.pred_boxes.tensor.cpu().numpy()[0])
         dict_ruler['bbox'] = [round(x) for x in ruler_bbox]
     except:
         ruler = None
     # find the number '2'
     try:
-        two = insts[insts.pred_classes == 3][0]
+        two = by_class[3][0]
     except:
         two = None
     # find the number '3'
     try:
-        three = insts[insts.pred_classes == 4][0]
+        three = by_class[4][0]
     except:
         three = None
 
@@ -206,7 +338,7 @@ def get_ruler_metadata(insts, file_name):
     return dict_ruler
 
 
-def get_fish_metadata (insts, im):
+def get_fish_metadata (by_class, image):
     '''
     This function work for one fish
     Collect metadat from fish
@@ -216,10 +348,10 @@ def get_fish_metadata (insts, im):
 
     Parameters
     ----------
-    insts : detectron instances Structure
-        Contained instances of object detected in each classes.
-    im : np.ndarray (h,w,3)
-        fish image in np.ndarray.
+    by_class : list of detectron instances Structure
+        Instances of object detected in each classes, from class_index.
+    image : ut.ImageContext
+        fish image, from predict_detectron.
 
     Returns
     -------
@@ -234,8 +366,8 @@ def get_fish_metadata (insts, im):
                "eye_bbox":"None", "eye_center":"None"}
 
     # Select the fish with highest score
-    main_fish_inst, num_fish = select_main_fish(insts)
-    im_enhance, im_gray = ut.enhance_contrast(im)
+    main_fish_inst, num_fish = select_main_fish(by_class[0])
+    im_gray = image.enhanced_gray
 
     dict_fish['fish_num']=num_fish
 
@@ -256,7 +388,7 @@ def get_fish_metadata (insts, im):
         # Convert bbox list in Boxes structure
         Boxes_fish = Boxes(torch.tensor(bbox)[None,:])
         # find the main eye in the main fish
-        main_eye_inst, num_eyes = find_main_eye(Boxes_fish, insts)
+        main_eye_inst, num_eyes = find_main_eye(Boxes_fish, by_class[2])
         # measure eye center and bbox
         eye_center = []
         if  main_eye_inst :
@@ -266,26 +398,27 @@ def get_fish_metadata (insts, im):
             dict_fish ['eye_center'] = eye_center
 
         ## Orientation  {'angle_degree' : "None" , 'eye_direction' :"None" }
-        dict_orientation = get_fish_orientation(mask_uint8, eye_center)
+        features = ut.fish_features(mask_uint8)
+        dict_orientation = get_fish_orientation(features, eye_center)
         # add the orientation metadata to the dict_fish
         dict_fish.update(dict_orientation)
 
         ## Brightness  {'foreground_mean':'None', 'foreground_std':'None',
         ##  'background_mean':'None', 'background_std':'None'}
-        dict_brightness= ut.get_brightness(im, mask_uint8, bbox)
+        dict_brightness= ut.get_brightness(image, mask_uint8, bbox)
         dict_fish.update(dict_brightness)
 
     return dict_fish, mask_uint8
 
 
-def select_main_fish(insts):
+def select_main_fish(fish):
     '''
     Select the fish with highest score >0.3 from instance object generated by detectron
 
     Parameters
     ----------
-    insts : detectron instance object (detectron2.structures.instances.Instances)
-        Check detectron2 documentation, basically list of list of instance objects.
+    fish : detectron instance object (detectron2.structures.instances.Instances)
+        Fish instances (class 0) detected by detectron.
 
     Returns
     -------
@@ -295,7 +428,6 @@ def select_main_fish(insts):
         number of fish detected by detectron.
 
     '''
-    fish = insts[insts.pred_classes == 0]
     num_fish = len(fish)
     main_fish=[]
 
@@ -310,7 +442,7 @@ def select_main_fish(insts):
     return main_fish, num_fish
 
            
-def generate_new_mask(fish, im_gray):
+def generate_new_mask(fish, im_gray, detect_size=DETECT_SIZE):
     '''
     Parameters
     ----------
@@ -318,6 +450,8 @@ def generate_new_mask(fish, im_gray):
         This particular instance represents a fish (class =0) with highest score.
     im_gray : numpy array
         Gray image with contrast enhance from ut.enhance_contrast .
+    detect_size : int, optional
+        When set (two-stage detection), the pixel analysis runs on a padded crop around the fish.
 
     Returns
     -------
@@ -330,17 +464,21 @@ def generate_new_mask(fish, im_gray):
 
     '''
     # convert the fish_instance mask into the numpy array
-    detectron_mask = fish.pred_masks[0].cpu().numpy()
+    detectron_mask = instance_mask(fish, im_gray.shape)
     # convert the fish_instance bbox into the list of float
     bbox = [round(x) for x in fish.pred_boxes.tensor.cpu().numpy().astype('float64')[0]]
 
-    bbox, mask, analysis_failed = ut.generate_pixel_analysis(bbox, im_gray, VAL_SCALE_FAC, detectron_mask)
+    if detect_size:
+        bbox, mask, analysis_failed = ut.generate_pixel_analysis_cropped(bbox, im_gray, VAL_SCALE_FAC,
+                                                                         detectron_mask)
+    else:
+        bbox, mask, analysis_failed = ut.generate_pixel_analysis(bbox, im_gray, VAL_SCALE_FAC, detectron_mask)
     mask_uint8 = np.where(mask == 1, 255, 0).astype(np.uint8)
 
     return mask_uint8, bbox, analysis_failed
 
 
-def find_main_eye(Boxes_fish, insts):
+def find_main_eye(Boxes_fish, eyes_insts):
     '''
     Find the eye with hightest score that overlap with  main_fish
 
@@ -348,8 +486,8 @@ def find_main_eye(Boxes_fish, insts):
     ----------
     fish_bbox : Boxes structure from detectron.structures
         single fish instance.
-    insts : detectron instance object (detectron2.structures.instances.Instances)
-        Check detectron2 documentation, basically list of list of instance objects.
+    eyes_insts : detectron instance object (detectron2.structures.instances.Instances)
+        Eye instances (class 2) detected by detectron.
 
     Returns
     -------
@@ -362,33 +500,30 @@ def find_main_eye(Boxes_fish, insts):
 
     main_eye = None
 
-    eyes_insts = insts[insts.pred_classes == 2]
     num_eyes = len(eyes_insts)
 
-    # eyes_insts are sort by score value in descending order
-    for idx in range(len(eyes_insts)):
+    if num_eyes:
+        # Boxes_fish and eyes are Boxes structure from detectron2, overlap of every eye in one call
+        overlap_fish_eye = pairwise_ioa(Boxes_fish.to(eyes_insts.pred_boxes.device),
+                                        eyes_insts.pred_boxes)[0] # intersecton over area2 from detectron
 
-
-        # Boxes_fish and eye are Boxes structure from detectron2
-        Boxes_eye = eyes_insts[idx].pred_boxes
-        overlap_fish_eye = pairwise_ioa(Boxes_fish, Boxes_eye).item() # intersecton over area2 from detectron
-
-        # find the first eye (highest score) in the fish (overlap>0.75)
-        if overlap_fish_eye > 0.75:
-            main_eye = eyes_insts[idx]
-            break
+        # eyes_insts are sort by score value in descending order,
+        # so the first eye in the fish (overlap>0.75) has the highest score
+        inside = torch.nonzero(overlap_fish_eye > 0.75)
+        if len(inside):
+            main_eye = eyes_insts[inside[0].item()]
     return main_eye, num_eyes
 
 
-def get_fish_orientation(mask_fish, eye_center):
+def get_fish_orientation(features, eye_center):
     '''
     Calculate the angle of the fish (using pca) regarding to horizontal line of the image and
     indicate the position of the eye right/left. The angle of the fish is reference to the horizontal
     line pointing to the left (standardized to the left because fishshould point to the left)
     Parameters
     ----------
-    mask_fish : Binary mask array with type uint8 (0, 255)
-        Mask of the fish output of ut.enhance_contrast.TYPE
+    features : ut.FishFeatures
+        Features of the fish mask, from ut.fish_features.
 
     eye_center : list of int
         center of the eye.
@@ -403,21 +538,17 @@ def get_fish_orientation(mask_fish, eye_center):
 
     dict_orientation= {'angle_degree' : "None" , 'eye_direction' :"None" }
 
-    # Clean the mask, convert to regionrops and select the biggest region
-    biggest_region = ut.clean_regionprop(mask_fish)
-
     # Collect the orientation and convert to angle with horizontale facing left
-    orientation = biggest_region.orientation
+    orientation = features.orientation
     angle = np.sign(orientation) * (90-abs(orientation*180/math.pi))
     dict_orientation["angle_degree"] = round(angle,2)
 
     ### get orientation left/right of the eye
-    fish_center = biggest_region.centroid # [row,col]
+    fish_center = features.centroid # [col,row], same format as eye_center
 
-    # eye_center format [col,row] is inverse compare to fish_center... don't ask!
-    if eye_center and eye_center[0] < fish_center[1]:
+    if eye_center and eye_center[0] < fish_center[0]:
         dict_orientation['eye_direction'] = 'left'
-    elif  eye_center and eye_center[0] > fish_center[1]:
+    elif  eye_center and eye_center[0] > fish_center[0]:
         dict_orientation['eye_direction'] = 'right'
 
     return dict_orientation
@@ -453,13 +584,14 @@ def main(file_path, output_json, output_mask):
     # empty mask if the analysis fail
     mask = np.zeros((100,100))
     try :
-        insts, im = predict_detectron(file_path)
+        insts, image = predict_detectron(file_path)
+        by_class = class_index(insts)
         # ruler metadata
-        dict_ruler = get_ruler_metadata(insts, file_path)
+        dict_ruler = get_ruler_metadata(by_class, file_path)
         # fish
-        dict_fish, mask = get_fish_metadata(insts, im)
+        dict_fish, mask = get_fish_metadata(by_class, image)
         # Morphology and statistic
-        #dict_morph_stat = ut.get_morphological_value(mask)
+        #dict_morph_stat = ut.get_morphological_value(ut.fish_features(mask))
 
         result = {'base_name': name_base, 'fish': dict_fish, 'ruler': dict_ruler}
 
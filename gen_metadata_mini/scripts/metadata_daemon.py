@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#' @description
+#' Long-lived inference daemon for generate_metadata_min.
+#' The daemon imports torch/detectron2 and loads the model once, then serves
+#' requests on a Unix socket. metadata_main.py acts as a thin client when
+#' DM_METADATA_SOCKET points to a running daemon, so each call only pays for
+#' the inference itself.
+#' This module must stay free of heavy imports: the client side is imported on
+#' every metadata_main.py call.
+
+import json
+import os
+import socket
+import socketserver
+import sys
+
+DEFAULT_SOCKET = os.environ.get('DM_METADATA_SOCKET', '/tmp/gen_metadata.sock')
+
+
+def _recv_line(conn):
+    '''
+    Read bytes from conn until a newline or the end of the stream.
+    '''
+    chunks = []
+    while True:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks)
+
+
+class MetadataRequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Handle one request: a JSON line {"file_path", "output_json", "output_mask"}.
+    Answers with a JSON line {"status": "ok"} or {"status": "error", "error": "..."}.
+    '''
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Liveness probe from daemon_running: the client connected and closed without a request
+            return
+        try:
+            request = json.loads(line)
+            self.server.gen_meta.main(request['file_path'], request['output_json'],
+                                      request.get('output_mask'))
+            response = {'status': 'ok'}
+        except Exception as e:
+            response = {'status': 'error', 'error': f'({e})'}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+def daemon_running(socket_path=DEFAULT_SOCKET):
+    '''
+    Check whether a daemon accepts connections on socket_path.
+
+    Parameters
+    ----------
+    socket_path : string, optional
+        Location of the Unix socket.
+
+    Returns
+    -------
+    running : bool
+        True when a daemon answers, False when the socket is missing or stale.
+
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def claim_socket(socket_path):
+    '''
+    Make socket_path available to a new daemon, removing a stale socket file left by a daemon
+    that did not shut down cleanly.
+
+    Raises
+    ------
+    RuntimeError
+        When a live daemon already serves on socket_path.
+
+    '''
+    if daemon_running(socket_path):
+        raise RuntimeError(f'A metadata daemon is already serving on {socket_path}')
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+
+def serve(socket_path=DEFAULT_SOCKET):
+    '''
+    Load the model and serve metadata requests on socket_path until interrupted.
+    Requests are handled one at a time, since the predictor is shared.
+
+    Parameters
+    ----------
+    socket_path : string, optional
+        Location of the Unix socket. The default is DM_METADATA_SOCKET or /tmp/gen_metadata.sock.
+
+    Returns
+    -------
+    None.
+
+    Raises
+    ------
+    RuntimeError
+        When another daemon already serves on socket_path.
+
+    '''
+    # Refuse before paying for the model load, and again before binding in case another
+    # daemon started meanwhile
+    claim_socket(socket_path)
+    import generate_metadata_min as gen_meta
+
+    # Warm up: load the weights before accepting the first request
+    gen_meta.init_model()
+    claim_socket(socket_path)
+    server = socketserver.UnixStreamServer(socket_path, MetadataRequestHandler)
+    server.gen_meta = gen_meta
+    print(f'Serving metadata requests on {socket_path}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def request(file_path, output_json, output_mask, socket_path=DEFAULT_SOCKET):
+    '''
+    Ask a running daemon to process one image. Paths are made absolute since the
+    daemon does not share the working directory of the caller.
+
+    Parameters
+    ----------
+    file_path : string
+        location of the image file to analyse.
+    output_json : string
+        path for the metadata output in json format.
+    output_mask : string or None
+        path for the mask image output in png format.
+    socket_path : string, optional
+        Location of the Unix socket.
+
+    Returns
+    -------
+    response : dictionnary
+        {'status': 'ok'} or {'status': 'error', 'error': '...'}.
+
+    Raises
+    ------
+    OSError
+        When no daemon is listening on socket_path.
+    ValueError
+        When the reply of the daemon is not valid JSON.
+
+    '''
+    payload = {'file_path': os.path.abspath(file_path),
+               'output_json': os.path.abspath(output_json),
+               'output_mask': os.path.abspath(output_mask) if output_mask else None}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(payload) + '\n').encode())
+        response = _recv_line(conn)
+    if not response:
+        return {'status': 'error', 'error': '(daemon closed the connection)'}
+    return json.loads(response)
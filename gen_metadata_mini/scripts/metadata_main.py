@@ -4,15 +4,50 @@
 Created on Fri Aug 12 09:49:05 2022
 
 @author: thibault
+
+Usage:
+    metadata_main.py <fish_image.jpg> <metadata.json> <mask.png>
+    metadata_main.py --serve [socket_path]
+
+With --serve the model is loaded once and kept warm behind a Unix socket.
+When DM_METADATA_SOCKET names the socket of a running daemon, the first form
+sends the image to it instead of importing torch/detectron2 and loading the
+weights again; without a reachable daemon it runs in-process as before.
 """
+import os
 import sys
-import generate_metadata_min as gen_meta
+import metadata_daemon
 
 if __name__ == '__main__':
 
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        socket_path = sys.argv[2] if len(sys.argv) > 2 else metadata_daemon.DEFAULT_SOCKET
+        try:
+            metadata_daemon.serve(socket_path)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(sys.argv) != 4:
+        print(__doc__[__doc__.index('Usage:'):].rstrip(), file=sys.stderr)
+        sys.exit(2)
+
     file_path = sys.argv[1]
     output_json = sys.argv[2]
     output_mask = sys.argv[3]
- 
-    gen_meta.main(file_path, output_json, output_mask)    
 
+    socket_path = os.environ.get('DM_METADATA_SOCKET')
+    if socket_path:
+        try:
+            response = metadata_daemon.request(file_path, output_json, output_mask, socket_path)
+            if response['status'] != 'ok':
+                print(f'{file_path}: daemon error {response["error"]}', file=sys.stderr)
+                sys.exit(1)
+            sys.exit(0)
+        except (OSError, ValueError) as e:
+            # ValueError: a malformed or truncated reply from the daemon
+            print(f'No metadata daemon on {socket_path} ({e}), running locally', file=sys.stderr)
+
+    import generate_metadata_min as gen_meta
+    gen_meta.main(file_path, output_json, output_mask)
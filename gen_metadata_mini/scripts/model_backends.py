@@ -0,0 +1,302 @@
+"""
+Exported inference backends for the fish/ruler/eye/two/three Mask R-CNN.
+
+Predictions can also be kept lazy (predict_lazy): boxes are mapped to the original image but the masks stay at
+ROI resolution (N, 1, 28, 28) until paste_masks is called for the instances that are actually used.
+
+An exported model is a frozen graph of the detector that no longer needs get_cfg/build_model at load time.
+The predictors below are drop-in replacements for detectron2's DefaultPredictor: they are called with a
+BGR image and return {'instances': Instances} with pred_boxes, pred_classes, scores and pred_masks at the
+original image size, so the rest of the metadata pipeline is unchanged.
+
+gen_metadata_mini/scripts/model_backends.py is a vendored copy of this module for the minimal pipeline, whose
+Docker build context only contains gen_metadata_mini. Edit model_backends.py at the repository root and copy it
+over unchanged; the release workflow checks that the two files are identical.
+"""
+import json
+import os
+from abc import ABC, abstractmethod
+
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import transforms as T
+from detectron2.export import TracingAdapter
+from detectron2.layers.mask_ops import paste_masks_in_image
+from detectron2.modeling import build_model
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances
+
+BACKENDS = ['detectron2', 'torchscript', 'onnx']
+# File extension of the exported artifact for each backend, next to model_final.pth
+BACKEND_EXTENSIONS = {'torchscript': '.ts', 'onnx': '.onnx'}
+# Post-training quantization modes of the detectron2 model
+QUANTIZE_MODES = ['int8']
+# Opset detectron2 supports for exporting Mask R-CNN to ONNX
+ONNX_OPSET_VERSION = 11
+# Order in which the traced model returns the fields of its Instances (detectron2 flattens them sorted by
+# name), followed by the image size.
+OUTPUT_FIELDS = ('pred_boxes', 'pred_classes', 'pred_masks', 'scores')
+# Preprocessing settings stored alongside the exported graph
+INPUT_CONFIG_FILE = 'input_config.json'
+
+
+def build_eager_model(cfg):
+    """
+    Builds the detectron2 model described by cfg and loads cfg.MODEL.WEIGHTS.
+    """
+    model = build_model(cfg)
+    model.eval()
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    return model
+
+
+def quantize_model(model, mode='int8'):
+    """
+    Applies post-training dynamic int8 quantization to a detectron2 model for CPU inference.
+    PyTorch only has dynamic int8 kernels for nn.Linear, which covers the box head and box predictor
+    (fc1 alone multiplies each of the ~1000 proposals by a 12544x1024 matrix). The convolutions of the
+    backbone, FPN and mask head stay in float32: quantizing them needs static quantization with
+    calibration data and quant/dequant stubs inside detectron2's modules.
+    """
+    if mode != 'int8':
+        raise ValueError(f'Unknown quantization mode: {mode}')
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def input_config(cfg):
+    """
+    Returns the preprocessing settings an exported predictor needs from cfg.
+    """
+    return {'format': cfg.INPUT.FORMAT, 'min_size': cfg.INPUT.MIN_SIZE_TEST,
+            'max_size': cfg.INPUT.MAX_SIZE_TEST}
+
+
+def input_augmentation(config):
+    """
+    Returns the resize DefaultPredictor applies for the preprocessing settings in config.
+    """
+    return T.ResizeShortestEdge([config['min_size'], config['min_size']], config['max_size'])
+
+
+def preprocess_image(original_image, input_format, aug, device='cpu', upsample=True):
+    """
+    Resizes a BGR image the way DefaultPredictor does and returns it as a float CHW tensor.
+    With upsample False, an image smaller than the model's test size is kept at its own size instead of
+    being enlarged back to it.
+    """
+    if input_format == 'RGB':
+        original_image = original_image[:, :, ::-1]
+    transform = aug.get_transform(original_image)
+    if upsample or transform.new_h < transform.h:
+        image = transform.apply_image(original_image)
+    else:
+        image = original_image
+    return torch.as_tensor(image.astype('float32').transpose(2, 0, 1)).to(device)
+
+
+def sample_input(cfg, sample_image):
+    """
+    Preprocesses the sample image used to trace the model described by cfg.
+    """
+    config = input_config(cfg)
+    return preprocess_image(sample_image, config['format'], input_augmentation(config), cfg.MODEL.DEVICE)
+
+
+def traceable_model(model, image):
+    """
+    Wraps a GeneralizedRCNN into a module taking a single CHW image tensor and returning flat tensors.
+    Masks are returned at ROI resolution (do_postprocess=False); they are pasted by the predictors.
+    """
+    def inference(model, inputs):
+        inst = model.inference(inputs, do_postprocess=False)[0]
+        return [{'instances': inst}]
+
+    return TracingAdapter(model, [{'image': image}], inference)
+
+
+def export_torchscript(cfg, sample_image, output_path):
+    """
+    Traces the model described by cfg on sample_image and saves a frozen TorchScript artifact.
+
+    Parameters:
+        cfg -- detectron2 config with the trained weights in cfg.MODEL.WEIGHTS.
+        sample_image -- BGR image used for tracing, preprocessed as at inference time.
+        output_path -- where to write the .ts file.
+    """
+    model = build_eager_model(cfg)
+    image = sample_input(cfg, sample_image)
+    adapter = traceable_model(model, image)
+    with torch.no_grad():
+        ts_model = torch.jit.trace(adapter, (image,))
+    ts_model = torch.jit.freeze(ts_model.eval())
+    torch.jit.save(ts_model, output_path, _extra_files={INPUT_CONFIG_FILE: json.dumps(input_config(cfg))})
+
+
+def export_onnx(cfg, sample_image, output_path):
+    """
+    Exports the model described by cfg to ONNX, tracing it on sample_image.
+    Height and width of the input are left dynamic, and the preprocessing settings are stored in the
+    model metadata.
+
+    Parameters:
+        cfg -- detectron2 config with the trained weights in cfg.MODEL.WEIGHTS.
+        sample_image -- BGR image used for tracing, preprocessed as at inference time.
+        output_path -- where to write the .onnx file.
+    """
+    import onnx
+
+    model = build_eager_model(cfg)
+    image = sample_input(cfg, sample_image)
+    adapter = traceable_model(model, image)
+    with torch.no_grad():
+        torch.onnx.export(adapter, (image,), output_path, opset_version=ONNX_OPSET_VERSION,
+                          input_names=['image'], output_names=list(OUTPUT_FIELDS) + ['image_size'],
+                          dynamic_axes={'image': {1: 'height', 2: 'width'}})
+    onnx_model = onnx.load(output_path)
+    onnx.helper.set_model_props(onnx_model, {INPUT_CONFIG_FILE: json.dumps(input_config(cfg))})
+    onnx.save(onnx_model, output_path)
+
+
+class ExportedPredictor(ABC):
+    """
+    Base class of the exported-model predictors, mirroring DefaultPredictor.__call__.
+    Subclasses implement run(image) returning the flat outputs in OUTPUT_FIELDS order.
+    """
+
+    def __init__(self, config, device='cpu'):
+        self.input_format = config['format']
+        self.aug = input_augmentation(config)
+        self.device = device or 'cpu'
+
+    def preprocess(self, original_image, upsample=True):
+        """
+        Resizes a BGR image the way DefaultPredictor does and returns it as a float CHW tensor.
+        """
+        return preprocess_image(original_image, self.input_format, self.aug, self.device, upsample)
+
+    @abstractmethod
+    def run(self, image):
+        """
+        Runs the exported graph on a preprocessed image and returns its flat outputs.
+        """
+
+    def predict_roi(self, image):
+        """
+        Runs the exported graph on a preprocessed image and returns its Instances, with boxes at the
+        preprocessed size and masks at ROI resolution.
+        """
+        with torch.no_grad():
+            outputs = self.run(image)
+        fields = dict(zip(OUTPUT_FIELDS, outputs))
+        fields['pred_boxes'] = Boxes(fields['pred_boxes'])
+        return Instances(tuple(image.shape[1:]), **fields)
+
+    def __call__(self, original_image):
+        height, width = original_image.shape[:2]
+        insts = self.predict_roi(self.preprocess(original_image))
+        return {'instances': detector_postprocess(insts, height, width)}
+
+
+class TorchScriptPredictor(ExportedPredictor):
+    """
+    Predictor backed by a TorchScript artifact written by export_torchscript.
+    """
+
+    def __init__(self, model_path, device='cpu'):
+        extra_files = {INPUT_CONFIG_FILE: ''}
+        self.model = torch.jit.load(model_path, map_location=device or 'cpu', _extra_files=extra_files)
+        super().__init__(json.loads(extra_files[INPUT_CONFIG_FILE]), device)
+
+    def run(self, image):
+        return self.model(image)
+
+
+class OnnxPredictor(ExportedPredictor):
+    """
+    Predictor running an artifact written by export_onnx with ONNX Runtime's CPU kernels.
+    """
+
+    def __init__(self, model_path, device='cpu'):
+        import onnxruntime as ort
+
+        self.session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        config = self.session.get_modelmeta().custom_metadata_map[INPUT_CONFIG_FILE]
+        # ONNX Runtime is only used on CPU here, whatever device the rest of the pipeline uses
+        super().__init__(json.loads(config), 'cpu')
+
+    def run(self, image):
+        outputs = self.session.run(None, {self.input_name: image.numpy()})
+        return [torch.from_numpy(output) for output in outputs]
+
+
+def exported_model_path(weights, backend):
+    """
+    Returns the artifact path used for backend, derived from the model_final.pth weights path.
+    """
+    if backend not in BACKEND_EXTENSIONS:
+        return weights
+    return os.path.splitext(weights)[0] + BACKEND_EXTENSIONS[backend]
+
+
+def load_exported_predictor(weights, backend, device=None):
+    """
+    Loads the exported artifact for backend that belongs to the model_final.pth weights.
+    """
+    model_path = exported_model_path(weights, backend)
+    if backend == 'torchscript':
+        return TorchScriptPredictor(model_path, device)
+    if backend == 'onnx':
+        return OnnxPredictor(model_path, device)
+    raise ValueError(f'Unknown inference backend: {backend}')
+
+
+def lazy_postprocess(results, output_height, output_width):
+    """
+    Same as detectron2's detector_postprocess, except that the masks are left at ROI resolution:
+    boxes are rescaled to the output size and clipped, and empty boxes are dropped.
+    """
+    scale_x = output_width / results.image_size[1]
+    scale_y = output_height / results.image_size[0]
+    results = Instances((output_height, output_width), **results.get_fields())
+    results.pred_boxes.scale(scale_x, scale_y)
+    results.pred_boxes.clip(results.image_size)
+    return results[results.pred_boxes.nonempty()]
+
+
+def predict_lazy(predictor, images, upsample=True):
+    """
+    Runs predictor on several BGR images, leaving the instance masks at ROI resolution.
+    DefaultPredictors run all images in a single forward pass, with the same preprocessing as
+    DefaultPredictor.__call__; exported predictors, whose graphs take a single image, run them in turn.
+
+    Parameters:
+        predictor -- DefaultPredictor or ExportedPredictor.
+        images -- list of BGR images.
+        upsample -- False to run images smaller than the model's test size (shortest side
+                    INPUT.MIN_SIZE_TEST) at their own size instead of enlarging them to it.
+    Returns:
+        insts -- list of Instances with boxes in image coordinates and (N, 1, M, M) pred_masks.
+    """
+    if isinstance(predictor, ExportedPredictor):
+        return [lazy_postprocess(predictor.predict_roi(predictor.preprocess(im, upsample)), *im.shape[:2])
+                for im in images]
+    inputs = []
+    for im in images:
+        height, width = im.shape[:2]
+        image = preprocess_image(im, predictor.input_format, predictor.aug, upsample=upsample)
+        inputs.append({'image': image, 'height': height, 'width': width})
+    with torch.no_grad():
+        results = predictor.model.inference(inputs, do_postprocess=False)
+    return [lazy_postprocess(r, i['height'], i['width']) for r, i in zip(results, inputs)]
+
+
+def paste_masks(insts, shape, threshold=0.5, offset=(0, 0)):
+    """
+    Pastes the ROI masks of insts into boolean masks of the image shape (height, width, ...).
+    With an (x, y) offset, shape is that of a window of the image whose top left corner is at offset.
+    """
+    boxes = insts.pred_boxes
+    if any(offset):
+        boxes = Boxes(boxes.tensor - boxes.tensor.new_tensor([offset[0], offset[1], offset[0], offset[1]]))
+    return paste_masks_in_image(insts.pred_masks[:, 0, :, :], boxes, tuple(shape[:2]), threshold=threshold).bool()
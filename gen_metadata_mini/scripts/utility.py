@@ -9,15 +9,51 @@
 #' Collect all the code that uses more standard image analyis method
 
 
+import math
 import cv2
 import numpy as np
-from random import shuffle
+from functools import cached_property
 from matplotlib import pyplot as plt
 from scipy import stats
-from skimage import filters, measure
-from skimage.morphology import flood_fill, reconstruction
+from skimage import measure
 from PIL import Image, ImageDraw
 
+# First step, as a fraction of the bbox size, by which the pixel analysis pushes out a bbox side the fish touches
+BBOX_GROW_STEP = 0.1
+# JPEG decode flags reducing the image by 8, 4 or 2 in the DCT domain, largest reduction first
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+def load_image(file_path, decode_size=0):
+    '''
+    Decode an image file once in BGR. When decode_size is set, JPEGs are decoded at the
+    largest 1/2, 1/4 or 1/8 reduction whose longest side is still at least decode_size.
+
+    Parameters
+    ----------
+    file_path : string
+        Location of the image file.
+    decode_size : int, optional
+        Minimum longest side of the decoded image, 0 to decode at full resolution.
+
+    Returns
+    -------
+    im : np.ndarray (dtype:uint8)
+        BGR image.
+
+    '''
+    flag = cv2.IMREAD_COLOR
+    if decode_size:
+        # only the header is read to get the size
+        with Image.open(file_path) as img:
+            longest = max(img.size)
+        for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+            if longest // factor >= decode_size:
+                flag = reduced_flag
+                break
+    return cv2.imread(file_path, flag)
+
 def enhance_contrast(image_arr):
     '''
     Contrast enhance method CLAHE to imporve deep learning prediction
@@ -35,27 +71,56 @@ def enhance_contrast(image_arr):
          CLAHE enhance converted to GRAY Color.
 
     '''
-    
-    im_gray = cv2.cvtColor(image_arr, cv2.COLOR_BGR2GRAY)
-    lab = cv2.cvtColor(image_arr, cv2.COLOR_BGR2LAB)
-    
-    # -----Splitting the LAB image to different channels-------------------------
-    l, a, b = cv2.split(lab)
+    context = ImageContext(image_arr)
+    return context.enhanced, context.enhanced_gray
+
+
+class ImageContext:
+    '''
+    The versions of one image used by the analysis. Each is computed the first time it is
+    used and kept for the rest of the analysis, so CLAHE runs at most once per image.
 
-    # -----Applying CLAHE to L-channel-------------------------------------------
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    cl = clahe.apply(l)
+    Attributes
+    ----------
+    bgr : np.ndarray (dtype:uint8)
+        image as loaded by cv2.
+    gray : np.ndarray (dtype:uint8)
+        gray version of bgr.
+    enhanced : np.ndarray (dtype:uint8)
+        CLAHE enhanced (on the L channel) BGR image, used for the prediction.
+    enhanced_gray : np.ndarray (dtype:uint8)
+        CLAHE enhanced gray image, used for the pixel analysis.
 
-    # -----Merge the CLAHE enhanced L-channel with the a and b channel-----------
-    limg = cv2.merge((cl, a, b))
+    '''
 
-    # -----Converting image from LAB Color model to RGB model--------------------
-    im_enhance = cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
+    def __init__(self, bgr):
+        self.bgr = bgr
 
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    im_gray = clahe.apply(im_gray)
-    
-    return im_enhance, im_gray
+    @cached_property
+    def gray(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def enhanced(self):
+        lab = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2LAB)
+
+        # -----Splitting the LAB image to different channels-------------------------
+        l, a, b = cv2.split(lab)
+
+        # -----Applying CLAHE to L-channel-------------------------------------------
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+        cl = clahe.apply(l)
+
+        # -----Merge the CLAHE enhanced L-channel with the a and b channel-----------
+        limg = cv2.merge((cl, a, b))
+
+        # -----Converting image from LAB Color model to RGB model--------------------
+        return cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
+
+    @cached_property
+    def enhanced_gray(self):
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+        return clahe.apply(self.gray)
 
 
 def calculate_scale(two, three, file_name):
@@ -109,12 +174,90 @@ def adaptive_threshold(bbox, im_gray, VAL_SCALE_FAC):
         new threshold
 
     """
-    im_crop = im_gray[bbox[1]:bbox[3], bbox[0]:bbox[2]]
-    val = filters.threshold_otsu(im_crop)
-    mask = np.where(im_crop > val, 1, 0).astype(np.uint8)
-    flat_mask = mask.reshape(-1)
-    bground = im_crop.reshape(-1)[np.where(np.logical_not(flat_mask))]
-    mean_b = np.mean(bground)
+    return histogram_threshold(crop_histogram(bbox, im_gray), VAL_SCALE_FAC)
+
+def crop_histogram(bbox, im_gray):
+    '''
+    256-bin histogram of the bounding box crop of a uint8 image.
+
+    Parameters
+    ----------
+    bbox : list (int)
+        Bounding box in [left, top, right, bottom] format.
+    im_gray : np.ndarray (dtype:uint8)
+        Grayscale version of original image.
+
+    Returns
+    -------
+    hist : np.ndarray (int)
+        Pixel count of each gray value in the crop.
+
+    '''
+    return np.bincount(im_gray[bbox[1]:bbox[3], bbox[0]:bbox[2]].ravel(), minlength=256)
+
+def grow_histogram(hist, bbox, new_bbox, im_gray):
+    '''
+    Add to the histogram of a crop the pixels of a grown bounding box that are outside the crop,
+    so the histogram of the grown crop costs the added pixels only.
+
+    Parameters
+    ----------
+    hist : np.ndarray (int)
+        Histogram of the bbox crop, updated in place.
+    bbox : list (int)
+        Bounding box of hist, in [left, top, right, bottom] format.
+    new_bbox : list (int)
+        Grown bounding box, containing bbox.
+    im_gray : np.ndarray (dtype:uint8)
+        Grayscale version of original image.
+
+    Returns
+    -------
+    hist : np.ndarray (int)
+        Histogram of the new_bbox crop.
+
+    '''
+    left, top, right, bottom = bbox
+    new_left, new_top, new_right, new_bottom = new_bbox
+    for strip in (im_gray[new_top:top, new_left:new_right], im_gray[bottom:new_bottom, new_left:new_right],
+                  im_gray[top:bottom, new_left:left], im_gray[top:bottom, right:new_right]):
+        hist += np.bincount(strip.ravel(), minlength=256)
+    return hist
+
+def histogram_threshold(hist, VAL_SCALE_FAC):
+    '''
+    adaptive_threshold computed from the histogram of the crop: Otsu threshold (as
+    filters.threshold_otsu on a uint8 image) moved away from the mean of the pixels at or
+    below it.
+
+    Parameters
+    ----------
+    hist : np.ndarray (int)
+        256-bin histogram of the crop, from crop_histogram.
+    VAL_SCALE_FAC : int
+        value scale factor.
+
+    Returns
+    -------
+    val: float 
+        new threshold
+
+    '''
+    values = np.flatnonzero(hist)
+    low, high = values[0], values[-1]
+    if low == high:
+        val = low
+    else:
+        counts = hist[low:high + 1].astype(np.float64)
+        bin_centers = np.arange(low, high + 1)
+        weight1 = np.cumsum(counts)
+        weight2 = np.cumsum(counts[::-1])[::-1]
+        mean1 = np.cumsum(counts * bin_centers) / weight1
+        mean2 = (np.cumsum((counts * bin_centers)[::-1]) / weight2[::-1])[::-1]
+        variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+        val = bin_centers[np.argmax(variance12)]
+    bground = hist[:val + 1]
+    mean_b = np.dot(bground, np.arange(val + 1)) / bground.sum()
     flipped = False
     diff = abs(mean_b - val)
     if flipped:
@@ -124,6 +267,53 @@ def adaptive_threshold(bbox, im_gray, VAL_SCALE_FAC):
     val = min(max(1, val), 254)
     return val
 
+def fish_component(thresh, min_fraction=0.1):
+    '''
+    Select the fish in a thresholded crop: the largest 8-connected region of below threshold
+    pixels, with its holes filled (see fill_holes).
+
+    Parameters
+    ----------
+    thresh : np.ndarray (dtype:uint8)
+        Binary crop, 1 where the pixel is below the threshold.
+    min_fraction : float, optional
+        Fraction of the crop the region has to cover. The default is 0.1.
+
+    Returns
+    -------
+    mask : np.ndarray (dtype:uint8) or None
+        Binary mask of the fish, None when no region covers more than min_fraction of the crop.
+
+    '''
+    labels = measure.label(thresh, connectivity=2)
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    fish = sizes.argmax()
+    if sizes[fish] / thresh.size <= min_fraction:
+        return None
+    return fill_holes(labels == fish).astype(np.uint8)
+
+def fill_holes(mask):
+    '''
+    Fill the holes of a binary mask: the 8-connected background regions that do not touch
+    its border. Same result as a reconstruction by erosion seeded from the border, in one
+    labeling pass.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Binary mask, non zero on the foreground.
+
+    Returns
+    -------
+    filled : np.ndarray (dtype:bool)
+        Mask with the holes filled.
+
+    '''
+    background = measure.label(mask == 0, connectivity=2)
+    border = np.concatenate([background[0], background[-1], background[:, 0], background[:, -1]])
+    return np.logical_not(np.isin(background, border[border > 0]))
+
 def generate_pixel_analysis(bbox, im_gray, VAL_SCALE_FAC, detectron_mask, flipped=False):
     """
     Generates a new mask for the fish using the puxel analysis.
@@ -131,6 +321,10 @@ def generate_pixel_analysis(bbox, im_gray, VAL_SCALE_FAC, detectron_mask, flippe
     bbox : round up bounding box from detectron
     val : adaptative threshold from fun adaptive_threshold
     detectron_mask : mask from detectron output
+    When the fish touches a side of the bbox, the side is pushed out by BBOX_GROW_STEP of the bbox
+    size, doubling the step on every pass it still touches, then pulled back to one pixel outside the fish.
+    The threshold and mask are then computed again on that final box, growing it again if the fish now
+    touches it.
     """
     
     val = adaptive_threshold(bbox, im_gray, VAL_SCALE_FAC)
@@ -138,81 +332,297 @@ def generate_pixel_analysis(bbox, im_gray, VAL_SCALE_FAC, detectron_mask, flippe
     bbox_orig = bbox.copy()
     left, top, right, bottom = bbox
     
-    im = im_gray.copy()
-    shape = im.shape
-    done = False
-    im_crop = im[top:bottom, left:right]
-    fish_pix, thresh, new_mask = None, None, None
-
-    while not done:
-        done = True
-        im_crop = im[top:bottom, left:right]
-        count = 0
+    shape = im_gray.shape
+    # steps and growth of the left, top, right and bottom sides
+    step_x = max(1, round((right - left) * BBOX_GROW_STEP))
+    step_y = max(1, round((bottom - top) * BBOX_GROW_STEP))
+    steps = [step_x, step_y, step_x, step_y]
+    grown = [False] * 4
+    # histogram of the crop, built when the bbox first grows
+    hist = None
+    # final boxes already thresholded, against a grow / pull back cycle
+    pulled_back = set()
+
+    while True:
+        im_crop = im_gray[top:bottom, left:right]
         thresh = np.where(im_crop < val, 1, 0).astype(np.uint8)
-        indices = list(zip(*np.where(thresh == 1)))
-        shuffle(indices)
-        for ind in indices:
-            if fish_pix is not None:
-                ind = fish_pix
-            count += 1
-            # if 10k pass and fish not found
-            if count > 10000:
-                if fish_pix is not None:
-                    fish_pix = None
-                else:
-                    print('ERROR on flood fill')
-                    return bbox_orig, detectron_mask.astype('uint8'), True
-            temp = flood_fill(thresh, ind, 2)
-            temp = np.where(temp == 2, 1, 0)
-            percent = np.count_nonzero(temp) / im_crop.size
-            if percent > 0.1:
-                fish_pix = ind
-                for i in (0, temp.shape[0] - 1):
-                    for j in (0, temp.shape[1] - 1):
-                        temp = flood_fill(temp, (i, j), 2)
-                thresh = np.where(temp != 2, 1, 0).astype(np.uint8)
+        if np.any(thresh):
+            thresh = fish_component(thresh)
+            if thresh is None:
+                print('ERROR on flood fill')
+                return bbox_orig, detectron_mask.astype('uint8'), True
+        touching = [left > 0 and np.any(thresh[:, 0]), top > 0 and np.any(thresh[0]),
+                    right < shape[1] and np.any(thresh[:, -1]), bottom < shape[0] and np.any(thresh[-1])]
+        if not any(touching):
+            if not any(grown) or not np.any(thresh):
+                break
+            final_bbox = tight_bbox(thresh, [left, top, right, bottom], grown, shape)
+            if final_bbox == [left, top, right, bottom] or tuple(final_bbox) in pulled_back:
                 break
-        new_mask = np.full(shape, 0).astype(np.uint8)
-        new_mask[top:bottom, left:right] = thresh
+            # The threshold came from the overshooting box: compute it and the mask again on the final box
+            pulled_back.add(tuple(final_bbox))
+            left, top, right, bottom = final_bbox
+            hist = crop_histogram(final_bbox, im_gray)
+            val = histogram_threshold(hist, VAL_SCALE_FAC)
+            steps = [step_x, step_y, step_x, step_y]
+            continue
+        crop_bbox = [left, top, right, bottom]
+        if hist is None:
+            hist = crop_histogram(crop_bbox, im_gray)
         # Expands the bounding box
-        try:
-            if np.any(new_mask[top:bottom, left] != 0) and left > 0:
-                left -= 1
-                left = max(0, left)
-                done = False
-            if np.any(new_mask[top:bottom, right] != 0) and right < shape[1] - 1:
-                right += 1
-                right = min(shape[1] - 1, right)
-                done = False
-            if np.any(new_mask[top, left:right] != 0) and top > 0:
-                top -= 1
-                top = max(0, top)
-                done = False
-            if np.any(new_mask[bottom, left:right] != 0) and bottom < shape[0] - 1:
-                bottom += 1
-                bottom = min(shape[0] - 1, bottom)
-                done = False
-        except:
-            print('Error expanding bounding box')
-            failed = True
-            return bbox_orig, detectron_mask.astype('uint8'), failed
-        # New bbox
-        bbox = [left, top, right, bottom]
-        # New threshold
-        val = adaptive_threshold(bbox, im_gray, VAL_SCALE_FAC)
-    if np.count_nonzero(thresh) / im_crop.size < .1:
+        left = max(0, left - steps[0]) if touching[0] else left
+        top = max(0, top - steps[1]) if touching[1] else top
+        right = min(shape[1], right + steps[2]) if touching[2] else right
+        bottom = min(shape[0], bottom + steps[3]) if touching[3] else bottom
+        steps = [step * 2 if touch else step for step, touch in zip(steps, touching)]
+        grown = [grow or touch for grow, touch in zip(grown, touching)]
+        # New threshold, from the histogram updated with the pixels the sides grew over
+        hist = grow_histogram(hist, crop_bbox, [left, top, right, bottom], im_gray)
+        val = histogram_threshold(hist, VAL_SCALE_FAC)
+    new_mask = np.zeros(shape, dtype=np.uint8)
+    new_mask[top:bottom, left:right] = thresh
+    if any(grown) and np.any(thresh):
+        left, top, right, bottom = tight_bbox(thresh, [left, top, right, bottom], grown, shape)
+    bbox = [left, top, right, bottom]
+    if np.count_nonzero(thresh) / ((bottom - top) * (right - left)) < .1:
         
         new_mask = detectron_mask.astype('uint8')
         bbox = bbox_orig
         failed = True
     return bbox, new_mask, failed
 
+def tight_bbox(thresh, bbox, grown, shape):
+    '''
+    Pull the grown sides of a bounding box back to one pixel outside the fish.
+
+    Parameters
+    ----------
+    thresh : np.ndarray (dtype=uint8)
+        Mask crop of the fish covering bbox, not empty.
+    bbox : list (int)
+        Bounding box of the crop in [left, top, right, bottom] format.
+    grown : list (bool)
+        Whether each of the left, top, right and bottom sides grew.
+    shape : tuple (int)
+        Shape of the image.
+
+    Returns
+    -------
+    bbox : list (int)
+        Pulled back bounding box in [left, top, right, bottom] format.
+
+    '''
+    left, top, right, bottom = bbox
+    rows = np.flatnonzero(thresh.any(axis=1))
+    cols = np.flatnonzero(thresh.any(axis=0))
+    return [max(0, left + int(cols[0]) - 1) if grown[0] else left,
+            max(0, top + int(rows[0]) - 1) if grown[1] else top,
+            min(shape[1], left + int(cols[-1]) + 2) if grown[2] else right,
+            min(shape[0], top + int(rows[-1]) + 2) if grown[3] else bottom]
+
+def padded_crop(bbox, shape, pad=0.25):
+    '''
+    Window around a bounding box, padded on each side and clipped to the image.
+
+    Parameters
+    ----------
+    bbox : list (int)
+        Bounding box in [left, top, right, bottom] format.
+    shape : tuple (int)
+        Shape of the image.
+    pad : float, optional
+        Padding as a fraction of the bbox width/height. The default is 0.25.
+
+    Returns
+    -------
+    window : tuple (int)
+        Padded window in (left, top, right, bottom) format.
+
+    '''
+    pad_x = round((bbox[2] - bbox[0]) * pad)
+    pad_y = round((bbox[3] - bbox[1]) * pad)
+    return (max(0, bbox[0] - pad_x), max(0, bbox[1] - pad_y),
+            min(shape[1], bbox[2] + pad_x), min(shape[0], bbox[3] + pad_y))
+
+def generate_pixel_analysis_cropped(bbox, im_gray, VAL_SCALE_FAC, detectron_mask, pad=0.25):
+    """
+    Runs generate_pixel_analysis on a padded crop around bbox instead of the whole image and
+    maps the resulting bbox and mask back to image coordinates.
+    """
+    left, top, right, bottom = padded_crop(bbox, im_gray.shape, pad)
+    crop_bbox = [bbox[0] - left, bbox[1] - top, bbox[2] - left, bbox[3] - top]
+    crop_bbox, crop_mask, failed = generate_pixel_analysis(crop_bbox, im_gray[top:bottom, left:right],
+                                                           VAL_SCALE_FAC,
+                                                           detectron_mask[top:bottom, left:right])
+    mask = np.zeros(im_gray.shape, dtype=np.uint8)
+    mask[top:bottom, left:right] = crop_mask
+    bbox = [crop_bbox[0] + left, crop_bbox[1] + top, crop_bbox[2] + left, crop_bbox[3] + top]
+    return bbox, mask, failed
+
+class FishFeatures:
+    '''
+    Shape features of one fish mask crop. Each feature is computed the first time it is used,
+    from intermediate results (moments, pixel coordinates, regionprops) shared with the others.
+
+    Attributes
+    ----------
+    mask : np.ndarray (dtype:uint8)
+        binary mask crop of the fish.
+    offset : tuple (int)
+        (x, y) position of mask in the full image.
+
+    '''
+
+    def __init__(self, mask, offset=(0, 0)):
+        self.mask = mask
+        self.offset = offset
+
+    @cached_property
+    def moments(self):
+        return cv2.moments(self.mask, binaryImage=True)
+
+    @cached_property
+    def coords(self):
+        """
+        x and y coordinates of the fish pixels in the crop.
+        """
+        y, x = np.nonzero(self.mask)
+        return x, y
+
+    @cached_property
+    def region(self):
+        return measure.regionprops(self.mask)[0]
+
+    @property
+    def area(self):
+        return len(self.coords[0])
+
+    @cached_property
+    def centroid(self):
+        """
+        Center of the fish in [x, y] format, in the full image.
+        """
+        m = self.moments
+        return np.array([m["m10"] / m["m00"] + self.offset[0], m["m01"] / m["m00"] + self.offset[1]])
+
+    @cached_property
+    def axes(self):
+        """
+        Eigenvectors of the covariance matrix of the fish pixels as columns, major axis first.
+        """
+        m = self.moments
+        # Same covariance matrix as np.cov of the fish pixel coordinates
+        cov = np.array([[m["mu20"], m["mu11"]],
+                        [m["mu11"], m["mu02"]]]) / (m["m00"] - 1)
+        evals, evecs = np.linalg.eig(cov)
+        return evecs[:, np.argsort(evals)[::-1]]
+
+    @cached_property
+    def inertia_eigvals(self):
+        """
+        Eigenvalues of the inertia tensor, largest first, as in skimage regionprops.
+        """
+        m = self.moments
+        a, b, c = m["mu20"] / m["m00"], -m["mu11"] / m["m00"], m["mu02"] / m["m00"]
+        root = math.sqrt(4 * b ** 2 + (a - c) ** 2)
+        return max(0, (a + c + root) / 2), max(0, (a + c - root) / 2)
+
+    @property
+    def eccentricity(self):
+        l1, l2 = self.inertia_eigvals
+        return math.sqrt(1 - l2 / l1) if l1 else 0
+
+    @property
+    def major_axis_length(self):
+        return 4 * math.sqrt(self.inertia_eigvals[0])
+
+    @property
+    def minor_axis_length(self):
+        return 4 * math.sqrt(self.inertia_eigvals[1])
+
+    @cached_property
+    def orientation(self):
+        """
+        Angle between the rows and the major axis, in radians, as in skimage regionprops.
+        """
+        m = self.moments
+        a, b, c = m["mu20"] / m["m00"], -m["mu11"] / m["m00"], m["mu02"] / m["m00"]
+        if a - c == 0:
+            return -math.pi / 4 if b < 0 else math.pi / 4
+        return 0.5 * math.atan2(-2 * b, c - a)
+
+    @cached_property
+    def projections(self):
+        """
+        Coordinates of the fish pixels along the major and minor axes, relative to the centroid.
+        """
+        x_v1, y_v1 = self.axes[:, 0]
+        # negate eigenvector
+        if x_v1 < 0:
+            x_v1 *= -1
+            y_v1 *= -1
+        m = self.moments
+        x, y = self.coords
+        x = x.astype(np.float32) - np.float32(m["m10"] / m["m00"])
+        y = y.astype(np.float32) - np.float32(m["m01"] / m["m00"])
+        return np.float32(x_v1) * x + np.float32(y_v1) * y, np.float32(x_v1) * y - np.float32(y_v1) * x
+
+    @cached_property
+    def dimensions(self):
+        """
+        Contour length and width, through the most populated row and column across the fish,
+        and overall length and width along the axes, in pixels.
+        """
+        x_round, y_round = (np.rint(p).astype(np.int32) for p in self.projections)
+        x_min, y_min = x_round.min(), y_round.min()
+        x_calc = np.bincount(x_round - x_min).argmax() + x_min
+        y_calc = np.bincount(y_round - y_min).argmax() + y_min
+        y_at_x, x_at_y = y_round[x_round == x_calc], x_round[y_round == y_calc]
+        return (float(x_at_y.max() - x_at_y.min()), float(y_at_x.max() - y_at_x.min()),
+                float(x_round.max() - x_min), float(y_round.max() - y_min))
+
+    @property
+    def extent(self):
+        x, y = self.coords
+        return self.area / ((x.max() - x.min() + 1) * (y.max() - y.min() + 1))
+
+    @property
+    def convex_area(self):
+        return self.region.convex_area
+
+    @property
+    def solidity(self):
+        return self.area / self.convex_area
+
+    @property
+    def feret_diameter_max(self):
+        return self.region.feret_diameter_max
+
+    @cached_property
+    def perimeter(self):
+        return measure.perimeter(self.mask, neighbourhood=8)
+
+    @cached_property
+    def skew(self):
+        return [stats.skew(c) for c in self.coords]
+
+    @cached_property
+    def kurtosis(self):
+        return [stats.kurtosis(c) for c in self.coords]
+
+    @cached_property
+    def std(self):
+        return [np.std(c) for c in self.coords]
+
+
 # https://alyssaq.github.io/2015/computing-the-axes-or-orientation-of-a-blob/
 def pca(img, glob_scale=None, visualize=False):
     """
     Performs principle component analysis on a grayscale image.
+    The axes come from the second order central moments of the mask, and
+    length and width from the projections of the fish pixels onto them.
     Parameters:
-        img -- grayscale image.
+        img -- grayscale image, or its FishFeatures.
         glob_scale -- pixels per unit.
     Returns:
         np.array(centroid) -- numpy array containing centroid.
@@ -221,57 +631,27 @@ def pca(img, glob_scale=None, visualize=False):
         width -- width of fish.
         area -- area of fish.
     """
-    moments = cv2.moments(img)
-    centroid = (int(moments["m10"] / moments["m00"]),
-                int(moments["m01"] / moments["m00"]))
-    y, x = np.nonzero(img)
-
-    x = x - np.mean(x)
-    y = y - np.mean(y)
-    coords = np.vstack([x, y])
-
-    cov = np.cov(coords)
-    evals, evecs = np.linalg.eig(cov)
-    sort_indices = np.argsort(evals)[::-1]
-    # Eigenvector with largest eigenvalue
-    x_v1, y_v1 = evecs[:, sort_indices[0]]
-    # negate eigenvector
-    if x_v1 < 0:
-        x_v1 *= -1
-        y_v1 *= -1
-    theta = np.arctan2(y_v1, x_v1)
-    rotation_mat = np.matrix([[np.cos(theta), -np.sin(theta)],
-                              [np.sin(theta), np.cos(theta)]])
-    transformed_mat = rotation_mat * coords
-    x_transformed, y_transformed = transformed_mat.A
-    x_round, y_round = x_transformed.round(
-        decimals=0), y_transformed.round(decimals=0)
-    x_vals, x_counts = np.unique(x_round, return_counts=True)
-    y_vals, y_counts = np.unique(y_round, return_counts=True)
-    x_calc, y_calc = x_vals[x_counts.argmax()], y_vals[y_counts.argmax()]
-    x_indices, y_indices = np.where(
-        x_round == x_calc), np.where(y_round == y_calc)
-    cont_width = y_round[x_indices].max() - y_round[x_indices].min()
-    cont_length = x_round[y_indices].max() - x_round[y_indices].min()
-    width = y_vals.max() - y_vals.min()
-    length = x_vals.max() - x_vals.min()
+    features = img if isinstance(img, FishFeatures) else FishFeatures(img)
+    centroid = features.centroid.astype(int)
+    cont_length, cont_width, length, width = features.dimensions
 
     if visualize:
-        x_v2, y_v2 = evecs[:, sort_indices[1]]
+        x_v1, y_v1 = features.axes[:, 0]
+        x_v2, y_v2 = features.axes[:, 1]
+        x, y = features.coords
+        x_transformed, y_transformed = features.projections
         scale = 300
         plt.plot([x_v1 * -scale * 2, x_v1 * scale * 2],
                  [y_v1 * -scale * 2, y_v1 * scale * 2], color='red')
         plt.plot([x_v2 * -scale, x_v2 * scale],
                  [y_v2 * -scale, y_v2 * scale], color='blue')
-        plt.plot(x, y, 'y.')
+        plt.plot(x - x.mean(), y - y.mean(), 'y.')
         plt.axis('equal')
         plt.gca().invert_yaxis()  # Match the image system with origin at top left
-        plt.axhline(y=y_calc)
-        plt.axvline(x=x_calc)
         plt.plot(x_transformed, y_transformed, 'g.')
         plt.show()
 
-    area = transformed_mat.shape[1]
+    area = features.area
     if glob_scale is not None:
         cont_length /= glob_scale
         cont_width /= glob_scale
@@ -279,7 +659,29 @@ def pca(img, glob_scale=None, visualize=False):
         width /= glob_scale
         area /= glob_scale ** 2
 
-    return np.array(centroid), evecs[:, sort_indices], cont_length, cont_width, length, width, area
+    return centroid, features.axes, cont_length, cont_width, length, width, area
+
+def fish_features(mask):
+    '''
+    Features of the fish in a mask of the whole image: its biggest region with the holes
+    filled, as in clean_regionprop, cropped to the bounding box of the mask.
+
+    Parameters
+    ----------
+    mask : np.ndarray (dtype:uint8)
+        Mask of the fish.
+
+    Returns
+    -------
+    features : FishFeatures
+        features of the fish region.
+
+    '''
+    x, y, w, h = cv2.boundingRect(mask)
+    labels = measure.label(fill_holes(mask[y:y + h, x:x + w]))
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    return FishFeatures((labels == sizes.argmax()).astype(np.uint8), (x, y))
 
 
 def clean_regionprop(mask):
@@ -300,9 +702,7 @@ def clean_regionprop(mask):
     '''
     
     # clean hole in the mask image    
-    seed = np.copy(mask)
-    seed[1:-1, 1:-1] = mask.max()
-    filled = reconstruction(seed, mask, method='erosion')
+    filled = fill_holes(mask)
     
     # Create the region prop
     mask_label = measure.label(filled)
@@ -345,14 +745,14 @@ def ioa_(box1, box2):
     return intersection_area/min_area
 
 
-def get_morphological_value(mask):
+def get_morphological_value(features):
     '''
     Calculate the morphological and Statistical information from an image mask.
     
     Parameters
     ----------
-    mask : np.ndarray (binary: 0,1)
-        Mask of the fish .
+    features : FishFeatures
+        Features of the fish mask, from fish_features.
 
     Returns
     -------
@@ -364,31 +764,27 @@ def get_morphological_value(mask):
     
     dict_Morpho_info={'extent':'None', 'eccentricity':'None',
                       'solidity':'None', 'skew':'None', 'kurtosis':'None'}
-    
-    # Create a clean regionprop for morphology analysis of the mask
-    region = clean_regionprop(mask)
 
     # Morphological infarmation
-    dict_Morpho_info['extent'] = region.extent
-    dict_Morpho_info['eccentricity'] = region.eccentricity
-    dict_Morpho_info['solidity'] = region.solidity
+    dict_Morpho_info['extent'] = features.extent
+    dict_Morpho_info['eccentricity'] = features.eccentricity
+    dict_Morpho_info['solidity'] = features.solidity
     
     # Statistic information
-    mask_coords = np.argwhere(mask != 0)[:, [1, 0]]
-    dict_Morpho_info['skew'] = list(stats.skew(mask_coords))
-    dict_Morpho_info['kurtosis'] = list(stats.kurtosis(mask_coords))
+    dict_Morpho_info['skew'] = features.skew
+    dict_Morpho_info['kurtosis'] = features.kurtosis
 
     return dict_Morpho_info
 
-def get_brightness(im, mask, bbox):
+def get_brightness(image, mask, bbox):
     '''
     Get quality image information such as foreground the fish and background around teh fish in the
     bounding box.
 
     Parameters
     ----------
-    im : np.ndarray
-        original image.
+    image : ImageContext
+        original image and its derived versions.
     mask : np.ndarray np.uint8
         mask of the fish.
     bbox : list of int
@@ -404,7 +800,7 @@ def get_brightness(im, mask, bbox):
     dict_brightness = {'foreground_mean':'None', 'foreground_std':'None', 
                           'background_mean':'None', 'background_std':'None'}
     
-    _, im_gray = enhance_contrast(im)
+    im_gray = image.enhanced_gray
     im_crop = im_gray[bbox[1]:bbox[3], bbox[0]:bbox[2]].reshape(-1)
     mask_crop = mask[bbox[1]:bbox[3], bbox[0]:bbox[2]].reshape(-1)
     fground = im_crop[np.where(mask_crop)]
@@ -0,0 +1,108 @@
+"""
+Encodings of the fish masks stored in the metadata JSON (`gen_metadata.py --mask-format`) and their decoders.
+Decoding only needs numpy (and pycocotools for RLE), so downstream jobs can read the masks without torch or
+detectron2.
+
+A mask record is, depending on the format:
+    freeman -- {'start_coord': [x, y], 'encoding': '2234...'}, one ASCII digit per 8-direction Freeman step.
+    freeman-packed -- {'start_coord': [x, y], 'encoding': base64, 'length': steps}, the steps packed in 3 bits.
+    rle -- {'size': [height, width], 'counts': string}, COCO compressed RLE of the mask in the full image.
+"""
+import base64
+
+import numpy as np
+
+MASK_FORMATS = ['freeman', 'freeman-packed', 'rle', 'none']
+# Freeman code (as ASCII) of a step between 8-neighbour contour points, indexed by [dy + 1, dx + 1]; 0 for no step
+FREEMAN_CODES = np.array([[ord('7'), ord('0'), ord('1')],
+                          [ord('6'), 0, ord('2')],
+                          [ord('5'), ord('4'), ord('3')]], dtype=np.uint8)
+# (dx, dy) step of each Freeman code
+FREEMAN_STEPS = np.array([[0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1], [-1, 0], [-1, -1]])
+# Weights of the 3 bits of a packed Freeman symbol, most significant first
+SYMBOL_BITS = np.array([4, 2, 1], dtype=np.uint8)
+
+
+def encode_freeman(image_contour):
+    """
+    Encode the image contour in an 8-direction freeman chain code based on angles.
+    Consecutive points of the rounded (row, col) contour are 8-neighbours or equal, so the code of
+    each step is looked up in FREEMAN_CODES, repeated points being skipped.
+    """
+    deltas = np.diff(np.asarray(image_contour), axis=0).astype(np.intp) + 1
+    codes = FREEMAN_CODES[deltas[:, 0], deltas[:, 1]]
+    return codes[codes > 0].tobytes().decode('ascii')
+
+
+def pack_freeman(code):
+    """
+    Packs a Freeman code string into 3 bits per step, returned as base64 text.
+    """
+    symbols = np.frombuffer(code.encode('ascii'), dtype=np.uint8) - ord('0')
+    bits = (symbols[:, None] >> np.array([2, 1, 0], dtype=np.uint8)) & 1
+    return base64.b64encode(np.packbits(bits.ravel()).tobytes()).decode('ascii')
+
+
+def freeman_symbols(record):
+    """
+    Returns the Freeman steps (0-7) of a freeman or freeman-packed mask record as a uint8 array.
+    """
+    if 'length' not in record:
+        return np.frombuffer(record['encoding'].encode('ascii'), dtype=np.uint8) - ord('0')
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(record['encoding']), dtype=np.uint8))
+    return bits[:3 * record['length']].reshape(-1, 3) @ SYMBOL_BITS
+
+
+def freeman_contour(start, symbols):
+    """
+    Returns the (steps + 1, 2) array of [x, y] points of the contour starting at start and following
+    the Freeman steps.
+    """
+    steps = FREEMAN_STEPS[np.asarray(symbols, dtype=np.intp)]
+    return np.concatenate([[start], np.asarray(start) + np.cumsum(steps, axis=0)])
+
+
+def decode_freeman_records(records):
+    """
+    Decodes many freeman or freeman-packed mask records with a single cumulative sum.
+    Parameters:
+        records -- list of mask records.
+    Returns:
+        contours -- list of arrays of [x, y] contour points, in the order of records.
+    """
+    if not records:
+        return []
+    symbols = [freeman_symbols(record) for record in records]
+    lengths = np.array([len(s) for s in symbols], dtype=np.intp)
+    # Position reached after each step of all the codes, chained, after a leading origin
+    chained = np.concatenate([[[0, 0]], np.cumsum(FREEMAN_STEPS[np.concatenate(symbols).astype(np.intp)], axis=0)])
+    # Contour i covers chained[first[i]:first[i] + lengths[i] + 1], moved so that it begins at its start_coord
+    first = np.cumsum(lengths) - lengths
+    index = np.arange(lengths.sum() + len(records)) - np.repeat(np.arange(len(records)), lengths + 1)
+    starts = np.array([record['start_coord'] for record in records], dtype=float).reshape(-1, 2)
+    points = chained[index] + np.repeat(starts - chained[first], lengths + 1, axis=0)
+    return np.split(points, np.cumsum(lengths + 1)[:-1])
+
+
+def encode_rle(mask, offset, shape):
+    """
+    Encodes a mask crop whose top left corner is at the (x, y) offset as the COCO RLE of a mask of the
+    image shape.
+    """
+    from pycocotools import mask as mask_utils
+
+    full = np.zeros(shape[:2], dtype=np.uint8, order='F')
+    full[offset[1]:offset[1] + mask.shape[0], offset[0]:offset[0] + mask.shape[1]] = mask != 0
+    rle = mask_utils.encode(full)
+    return {'size': rle['size'], 'counts': rle['counts'].decode('ascii')}
+
+
+def decode_rle_records(records):
+    """
+    Decodes many rle mask records of the same image size in a single pycocotools call.
+    Returns:
+        masks -- (height, width, len(records)) uint8 array of binary masks.
+    """
+    from pycocotools import mask as mask_utils
+
+    return mask_utils.decode([{'size': r['size'], 'counts': r['counts'].encode('ascii')} for r in records])
@@ -218,8 +218,7 @@ def gen_metadata(file_path):
                         results['fish'][i]['side'] = 'right'
                     x_mid = int(bbox[0] + (bbox[2] - bbox[0]) / 2)
                     y_mid = int(bbox[1] + (bbox[3] - bbox[1]) / 2)
-                    # snout_vec = find_snout_vec(np.array([x_mid, y_mid]), eye_center, mask)
-                    snout_vec = evec
+                    snout_vec = find_snout_vec(np.array([x_mid, y_mid]), eye_center, mask)
                     if snout_vec is None:
                         results['fish'][i]['clock_value'] = \
                             clock_value(evec, file_name)
@@ -262,39 +261,26 @@ def adaptive_threshold(bbox, im_gray):
 
 
 def find_snout_vec(centroid, eye_center, mask):
-    eye_dir = eye_center - centroid
-    x1 = centroid[0]
-    y1 = centroid[1]
-    # print(centroid)
-    # print(eye_center)
-    # print(eye_dir)
-    max_len = 0
-    # fallback = np.array([-1,0])
-    max_vec = None
-    for x in range(mask.shape[1]):
-        for y in range(mask.shape[0]):
-            # print((x, y))
-            if mask[y, x]:
-                x2 = x
-                y2 = y
-                curr_dir = np.array([x2 - x1, y2 - y1])
-                curr_eye_dir = np.array([x2 - eye_center[0],
-                                         y2 - eye_center[1]])
-                curr_len = np.linalg.norm(curr_dir)
-                if curr_len > max_len:
-                    fallback = curr_dir
-                    max_len = curr_len
-                    if curr_len > np.linalg.norm(curr_eye_dir):
-                        max_vec = curr_dir
-    # print(max_vec)
+    # Fish pixels in [x, y] format, visited column by column
+    x, y = np.nonzero(mask.T)
+    if not len(x):
+        return None
+    coords = np.column_stack([x, y])
+    curr_dir = coords - np.asarray(centroid)
+    curr_len = np.linalg.norm(curr_dir, axis=1)
+    curr_eye_len = np.linalg.norm(coords - np.asarray(eye_center), axis=1)
+    # The snout is the last pixel that was the farthest from the centroid so
+    # far when visited while being farther from the centroid than from the eye
+    prev_max = np.maximum.accumulate(np.concatenate([[0], curr_len[:-1]]))
+    snout = np.flatnonzero((curr_len > prev_max) & (curr_len > curr_eye_len))
+    max_len = curr_len.max()
     if max_len == 0:
         # return np.array([-1,0])
         return None
-    if max_vec is None:
+    if not len(snout):
         print(f'Failed snout')
-        # max_vec = fallback
         return None
-    return max_vec / max_len
+    return curr_dir[snout[-1]] / max_len
 
 
 def angle(vec1, vec2):
@@ -332,26 +318,12 @@ def clock_value(evec, file_name):
 
 
 def fish_length(mask, centroid, evec, scale):
-    m1 = evec[1] / evec[0]
-    m2 = evec[0] / evec[1]
-    x1 = centroid[0]
-    y1 = centroid[1]
-    x_min = centroid[0]
-    x_max = centroid[0]
-    for x in range(mask.shape[1]):
-        for y in range(mask.shape[0]):
-            if mask[y, x]:
-                x2 = x
-                y2 = y
-                x_calc = (-y1 + y2 + m1 * x1 - m2 * x2) / (m1 - m2)
-                y_calc = m1 * (x - x1) + y1
-                if x_calc > x_max:
-                    x_max = x_calc
-                    y_max = y_calc
-                elif x_calc < x_min:
-                    x_min = x_calc
-                    y_min = y_calc
-    return distance((x_max, y_max), (x_min, y_min)) / scale
+    # Project every fish pixel onto the major axis, the centroid being the
+    # initial extremum in each direction
+    y, x = np.nonzero(mask)
+    coords = np.column_stack([x, y]) - np.asarray(centroid)
+    proj = coords @ (np.asarray(evec) / np.linalg.norm(evec))
+    return (proj.max(initial=0) - proj.min(initial=0)) / scale
 
 
 def overlap(fish, eye):